@@ -27,9 +27,10 @@ from api.db.services.dialog_service import DialogService, chat
 from api.db.services.document_service import DocumentService
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db.services.user_service import UserTenantService
-from api.settings import RetCode
+from api.settings import RetCode, stat_logger
 from api.utils import get_uuid, current_timestamp, datetime_format
-from api.utils.api_utils import server_error_response, get_data_error_result, get_json_result, validate_request
+from api.utils.api_utils import server_error_response, get_data_error_result, get_json_result, validate_request, \
+    sse_data, sse_response
 from itsdangerous import URLSafeTimedSerializer
 
 from api.utils.file_utils import filename_type, thumbnail
@@ -180,13 +181,35 @@ def completion():
             return get_data_error_result(retmsg="Dialog not found!")
         del req["conversation_id"]
         del req["messages"]
-        ans = chat(dia, msg, **req)
+        stream = req.pop("stream", False)
         if not conv.reference:
             conv.reference = []
-        conv.reference.append(ans["reference"])
-        conv.message.append({"role": "assistant", "content": ans["answer"]})
-        API4ConversationService.append_message(conv.id, conv.to_dict())
-        return get_json_result(data=ans)
+        conv.reference.append({"chunks": [], "doc_aggs": []})
+        conv.message.append({"role": "assistant", "content": ""})
+
+        def fillin_conv(ans):
+            conv.reference[-1] = ans["reference"]
+            conv.message[-1] = {"role": "assistant", "content": ans["answer"]}
+
+        if not stream:
+            for ans in chat(dia, msg, False, **req):
+                fillin_conv(ans)
+            API4ConversationService.append_message(conv.id, conv.to_dict())
+            return get_json_result(data=ans)
+
+        def events():
+            try:
+                for ans in chat(dia, msg, True, **req):
+                    fillin_conv(ans)
+                    yield sse_data(data=ans)
+                API4ConversationService.append_message(conv.id, conv.to_dict())
+            except Exception as e:
+                stat_logger.exception(e)
+                yield sse_data(retcode=RetCode.EXCEPTION_ERROR, retmsg=repr(e),
+                               data={"answer": "**ERROR**: " + str(e), "reference": []})
+            yield sse_data(data=True)
+
+        return sse_response(events())
     except Exception as e:
         return server_error_response(e)
 
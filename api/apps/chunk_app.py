@@ -22,7 +22,9 @@ from elasticsearch_dsl import Q
 from rag.app.qa import rmPrefix, beAdoc
 from rag.nlp import search, rag_tokenizer
 from rag.utils.es_conn import ELASTICSEARCH
+from rag.utils.embedding_store import EMBEDDING_STORE
 from rag.utils import rmSpace
+from rag.utils.retrieval_cache import bump_kb_version
 from api.db import LLMType, ParserType
 from api.db.services.knowledgebase_service import KnowledgebaseService
 from api.db.services.llm_service import TenantLLMService
@@ -154,10 +156,13 @@ def set():
             d = beAdoc(d, arr[0], arr[1], not any(
                 [rag_tokenizer.is_chinese(t) for t in q + a]))
 
-        v, c = embd_mdl.encode([doc.name, req["content_with_weight"]])
+        d["term_with_weight"] = retrievaler.qryr.tw.chunk_weights(
+            d["content_ltks"], rag_tokenizer.tokenize(re.sub(r"\.[a-zA-Z]+$", "", doc.name)), d["important_kwd"])
+        v, c = EMBEDDING_STORE.encode(embd_mdl, [doc.name, req["content_with_weight"]])
         v = 0.1 * v[0] + 0.9 * v[1] if doc.parser_id != ParserType.QA else v[1]
         d["q_%d_vec" % len(v)] = v.tolist()
         ELASTICSEARCH.upsert([d], search.index_name(tenant_id))
+        bump_kb_version(doc.kb_id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -172,9 +177,13 @@ def switch():
         tenant_id = DocumentService.get_tenant_id(req["doc_id"])
         if not tenant_id:
             return get_data_error_result(retmsg="Tenant not found!")
+        e, doc = DocumentService.get_by_id(req["doc_id"])
+        if not e:
+            return get_data_error_result(retmsg="Document not found!")
         if not ELASTICSEARCH.upsert([{"id": i, "available_int": int(req["available_int"])} for i in req["chunk_ids"]],
                                     search.index_name(tenant_id)):
             return get_data_error_result(retmsg="Index updating failure")
+        bump_kb_version(doc.kb_id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -189,6 +198,11 @@ def rm():
         if not ELASTICSEARCH.deleteByQuery(
                 Q("ids", values=req["chunk_ids"]), search.index_name(current_user.id)):
             return get_data_error_result(retmsg="Index updating failure")
+        e, doc = DocumentService.get_by_id(req["doc_id"]) if req.get("doc_id") else (False, None)
+        if e:
+            bump_kb_version(doc.kb_id)
+        else:
+            bump_kb_version(*[kb.id for kb in KnowledgebaseService.query(tenant_id=current_user.id)])
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -222,13 +236,14 @@ def create():
         if not tenant_id:
             return get_data_error_result(retmsg="Tenant not found!")
 
+        d["term_with_weight"] = retrievaler.qryr.tw.chunk_weights(d["content_ltks"], "", d["important_kwd"])
         embd_mdl = TenantLLMService.model_instance(
             tenant_id, LLMType.EMBEDDING.value)
-        v, c = embd_mdl.encode([doc.name, req["content_with_weight"]])
-        DocumentService.increment_chunk_num(req["doc_id"], doc.kb_id, c, 1, 0)
+        v, c = EMBEDDING_STORE.encode(embd_mdl, [doc.name, req["content_with_weight"]])
         v = 0.1 * v[0] + 0.9 * v[1]
         d["q_%d_vec" % len(v)] = v.tolist()
         ELASTICSEARCH.upsert([d], search.index_name(tenant_id))
+        DocumentService.increment_chunk_num(req["doc_id"], doc.kb_id, c, 1, 0)
         return get_json_result(data={"chunk_id": chunck_id})
     except Exception as e:
         return server_error_response(e)
@@ -266,3 +281,41 @@ def retrieval_test():
             return get_json_result(data=False, retmsg=f'No chunk found! Check the chunk status please!',
                                    retcode=RetCode.DATA_ERROR)
         return server_error_response(e)
+
+
+@manager.route('/retrieval_batch', methods=['POST'])
+@login_required
+@validate_request("kb_id", "questions")
+def retrieval_batch():
+    req = request.json
+    page = int(req.get("page", 1))
+    size = int(req.get("size", 30))
+    questions = req["questions"]
+    kb_id = req["kb_id"]
+    doc_ids = req.get("doc_ids", [])
+    similarity_threshold = float(req.get("similarity_threshold", 0.2))
+    vector_similarity_weight = float(req.get("vector_similarity_weight", 0.3))
+    top = int(req.get("top_k", 1024))
+    if not isinstance(questions, list):
+        return get_json_result(data=False, retmsg='"questions" should be a list of strings!',
+                               retcode=RetCode.ARGUMENT_ERROR)
+    try:
+        e, kb = KnowledgebaseService.get_by_id(kb_id)
+        if not e:
+            return get_data_error_result(retmsg="Knowledgebase not found!")
+
+        embd_mdl = TenantLLMService.model_instance(
+            kb.tenant_id, LLMType.EMBEDDING.value, llm_name=kb.embd_id)
+        res = retrievaler.retrieval_batch(questions, embd_mdl, kb.tenant_id, [kb_id], page, size,
+                                          similarity_threshold, vector_similarity_weight, top, doc_ids)
+        for ranks in res:
+            for c in ranks["chunks"]:
+                if "vector" in c:
+                    del c["vector"]
+
+        return get_json_result(data=res)
+    except Exception as e:
+        if str(e).find("not_found") > 0:
+            return get_json_result(data=False, retmsg=f'No chunk found! Check the chunk status please!',
+                                   retcode=RetCode.DATA_ERROR)
+        return server_error_response(e)
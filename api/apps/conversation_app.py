@@ -18,7 +18,8 @@ from flask_login import login_required
 from api.db.services.dialog_service import DialogService, ConversationService, chat
 from api.utils.api_utils import server_error_response, get_data_error_result, validate_request
 from api.utils import get_uuid
-from api.utils.api_utils import get_json_result
+from api.utils.api_utils import get_json_result, sse_data, sse_response
+from api.settings import RetCode, stat_logger
 
 
 @manager.route('/set', methods=['POST'])
@@ -123,13 +124,35 @@ def completion():
             return get_data_error_result(retmsg="Dialog not found!")
         del req["conversation_id"]
         del req["messages"]
-        ans = chat(dia, msg, **req)
+        stream = req.pop("stream", False)
         if not conv.reference:
             conv.reference = []
-        conv.reference.append(ans["reference"])
-        conv.message.append({"role": "assistant", "content": ans["answer"]})
-        ConversationService.update_by_id(conv.id, conv.to_dict())
-        return get_json_result(data=ans)
+        conv.reference.append({"chunks": [], "doc_aggs": []})
+        conv.message.append({"role": "assistant", "content": ""})
+
+        def fillin_conv(ans):
+            conv.reference[-1] = ans["reference"]
+            conv.message[-1] = {"role": "assistant", "content": ans["answer"]}
+
+        if not stream:
+            for ans in chat(dia, msg, False, **req):
+                fillin_conv(ans)
+            ConversationService.update_by_id(conv.id, conv.to_dict())
+            return get_json_result(data=ans)
+
+        def events():
+            try:
+                for ans in chat(dia, msg, True, **req):
+                    fillin_conv(ans)
+                    yield sse_data(data=ans)
+                ConversationService.update_by_id(conv.id, conv.to_dict())
+            except Exception as e:
+                stat_logger.exception(e)
+                yield sse_data(retcode=RetCode.EXCEPTION_ERROR, retmsg=repr(e),
+                               data={"answer": "**ERROR**: " + str(e), "reference": []})
+            yield sse_data(data=True)
+
+        return sse_response(events())
     except Exception as e:
         return server_error_response(e)
 
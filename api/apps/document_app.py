@@ -37,6 +37,7 @@ from api.db.services.document_service import DocumentService
 from api.settings import RetCode
 from api.utils.api_utils import get_json_result
 from rag.utils.minio_conn import MINIO
+from rag.utils.retrieval_cache import bump_kb_version
 from api.utils.file_utils import filename_type, thumbnail
 
 
@@ -215,6 +216,7 @@ def change_status():
                                               idxnm=search.index_name(
                                                   kb.tenant_id)
                                               )
+        bump_kb_version(kb.id)
         return get_json_result(data=True)
     except Exception as e:
         return server_error_response(e)
@@ -277,6 +279,9 @@ def run():
                 return get_data_error_result(retmsg="Tenant not found!")
             ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=id), idxnm=search.index_name(tenant_id))
+            e, doc = DocumentService.get_by_id(id)
+            if e:
+                bump_kb_version(doc.kb_id)
 
         return get_json_result(data=True)
     except Exception as e:
@@ -383,6 +388,7 @@ def change_parser():
                 return get_data_error_result(retmsg="Tenant not found!")
             ELASTICSEARCH.deleteByQuery(
                 Q("match", doc_id=doc.id), idxnm=search.index_name(tenant_id))
+            bump_kb_version(doc.kb_id)
 
         return get_json_result(data=True)
     except Exception as e:
@@ -23,7 +23,9 @@ from api.db.services.llm_service import LLMService, TenantLLMService, LLMBundle
 from api.settings import chat_logger, retrievaler
 from rag.app.resume import forbidden_select_fields4resume
 from rag.nlp.search import index_name
-from rag.utils import rmSpace, num_tokens_from_string, encoder
+from rag.utils import rmSpace
+from rag.utils.answer_cache import ANSWER_CACHE
+from rag.utils.token_counter import TOKEN_COUNTER
 
 
 class DialogService(CommonService):
@@ -35,43 +37,36 @@ class ConversationService(CommonService):
 
 
 def message_fit_in(msg, max_length=4000):
-    def count():
-        nonlocal msg
-        tks_cnts = []
-        for m in msg:
-            tks_cnts.append(
-                {"role": m["role"], "count": num_tokens_from_string(m["content"])})
-        total = 0
-        for m in tks_cnts:
-            total += m["count"]
-        return total
-
-    c = count()
+    cnts = TOKEN_COUNTER.count_batch([m["content"] for m in msg])
+    c = sum(cnts)
     if c < max_length:
         return c, msg
 
-    msg_ = [m for m in msg[:-1] if m["role"] == "system"]
+    msg_ = [m for m, _ in zip(msg[:-1], cnts) if m["role"] == "system"]
+    cnts_ = [n for m, n in zip(msg[:-1], cnts) if m["role"] == "system"]
     msg_.append(msg[-1])
+    cnts_.append(cnts[-1])
     msg = msg_
-    c = count()
+    c = sum(cnts_)
     if c < max_length:
         return c, msg
 
-    ll = num_tokens_from_string(msg_[0].content)
-    l = num_tokens_from_string(msg_[-1].content)
-    if ll / (ll + l) > 0.8:
-        m = msg_[0].content
-        m = encoder.decode(encoder.encode(m)[:max_length - l])
-        msg[0].content = m
+    ll = cnts_[0]
+    l = cnts_[-1]
+    if len(msg) > 1 and ll / (ll + l) > 0.8:
+        msg[0]["content"] = TOKEN_COUNTER.truncate(msg[0]["content"], max_length - (c - ll))
         return max_length, msg
 
-    m = msg_[1].content
-    m = encoder.decode(encoder.encode(m)[:max_length - l])
-    msg[1].content = m
+    msg[-1]["content"] = TOKEN_COUNTER.truncate(msg[-1]["content"], max_length - (c - l))
     return max_length, msg
 
 
-def chat(dialog, messages, **kwargs):
+def chat(dialog, messages, stream=True, **kwargs):
+    """
+    Yields {"answer", "reference"}. If `stream`, the answer generated so far is
+    yielded as it grows, with an empty reference, and the last one yielded
+    carries the citations and the reference; otherwise only that last one is.
+    """
     assert messages[-1]["role"] == "user", "The last content of this conversation is not from user."
     llm = LLMService.query(llm_name=dialog.llm_id)
     if not llm:
@@ -94,7 +89,9 @@ def chat(dialog, messages, **kwargs):
     if field_map:
         chat_logger.info("Use SQL to retrieval:{}".format(questions[-1]))
         ans = use_sql(questions[-1], field_map, dialog.tenant_id, chat_mdl, prompt_config.get("quote", True))
-        if ans: return ans
+        if ans:
+            yield ans
+            return
 
     for p in prompt_config["parameters"]:
         if p["key"] == "knowledge":
@@ -105,6 +102,16 @@ def chat(dialog, messages, **kwargs):
             prompt_config["system"] = prompt_config["system"].replace(
                 "{%s}" % p["key"], " ")
 
+    # only the first question of a conversation is answered regardless of the history
+    cache_scope = ANSWER_CACHE.scope(dialog, kwargs) if len(questions) == 1 else None
+    if cache_scope:
+        qv, _ = embd_mdl.encode_queries(questions[-1])
+        ans = ANSWER_CACHE.get(cache_scope, qv)
+        if ans:
+            chat_logger.info("Answer of '{}' from cache".format(questions[-1]))
+            yield ans
+            return
+
     for _ in range(len(questions) // 2):
         questions.append(questions[-1])
     if "knowledge" not in [p["key"] for p in prompt_config["parameters"]]:
@@ -118,8 +125,8 @@ def chat(dialog, messages, **kwargs):
         "{}->{}".format(" ".join(questions), "\n->".join(knowledges)))
 
     if not knowledges and prompt_config.get("empty_response"):
-        return {
-            "answer": prompt_config["empty_response"], "reference": kbinfos}
+        yield {"answer": prompt_config["empty_response"], "reference": kbinfos}
+        return
 
     kwargs["knowledge"] = "\n".join(knowledges)
     gen_conf = dialog.llm_setting
@@ -130,33 +137,45 @@ def chat(dialog, messages, **kwargs):
         gen_conf["max_tokens"] = min(
             gen_conf["max_tokens"],
             max_tokens - used_token_count)
-    answer = chat_mdl.chat(
-        prompt_config["system"].format(
-            **kwargs), msg, gen_conf)
-    chat_logger.info("User: {}|Assistant: {}".format(
-        msg[-1]["content"], answer))
-
-    if knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
-        answer, idx = retrievaler.insert_citations(answer,
-                                                   [ck["content_ltks"]
-                                                       for ck in kbinfos["chunks"]],
-                                                   [ck["vector"]
-                                                       for ck in kbinfos["chunks"]],
-                                                   embd_mdl,
-                                                   tkweight=1 - dialog.vector_similarity_weight,
-                                                   vtweight=dialog.vector_similarity_weight)
-        idx = set([kbinfos["chunks"][int(i)]["doc_id"] for i in idx])
-        recall_docs = [
-            d for d in kbinfos["doc_aggs"] if d["doc_id"] in idx]
-        if not recall_docs: recall_docs = kbinfos["doc_aggs"]
-        kbinfos["doc_aggs"] = recall_docs
-
-    for c in kbinfos["chunks"]:
-        if c.get("vector"):
-            del c["vector"]
-    if answer.lower().find("invalid key") >= 0 or answer.lower().find("invalid api")>=0:
-        answer += " Please set LLM API-Key in 'User Setting -> Model Providers -> API-Key'"
-    return {"answer": answer, "reference": kbinfos}
+
+    def decorate_answer(answer):
+        chat_logger.info("User: {}|Assistant: {}".format(
+            msg[-1]["content"], answer))
+
+        if knowledges and (prompt_config.get("quote", True) and kwargs.get("quote", True)):
+            answer, idx = retrievaler.insert_citations(answer,
+                                                       [ck["content_ltks"]
+                                                           for ck in kbinfos["chunks"]],
+                                                       [ck["vector"]
+                                                           for ck in kbinfos["chunks"]],
+                                                       embd_mdl,
+                                                       tkweight=1 - dialog.vector_similarity_weight,
+                                                       vtweight=dialog.vector_similarity_weight)
+            idx = set([kbinfos["chunks"][int(i)]["doc_id"] for i in idx])
+            recall_docs = [
+                d for d in kbinfos["doc_aggs"] if d["doc_id"] in idx]
+            if not recall_docs: recall_docs = kbinfos["doc_aggs"]
+            kbinfos["doc_aggs"] = recall_docs
+
+        for c in kbinfos["chunks"]:
+            if c.get("vector"):
+                del c["vector"]
+        if answer.lower().find("invalid key") >= 0 or answer.lower().find("invalid api")>=0:
+            answer += " Please set LLM API-Key in 'User Setting -> Model Providers -> API-Key'"
+        elif cache_scope and answer.find("**ERROR**") < 0:
+            ANSWER_CACHE.put(cache_scope, qv, {"answer": answer, "reference": kbinfos})
+        return {"answer": answer, "reference": kbinfos}
+
+    system = prompt_config["system"].format(**kwargs)
+    if stream:
+        answer = ""
+        for ans in chat_mdl.chat_streamly(system, msg, gen_conf):
+            answer = ans
+            yield {"answer": answer, "reference": {}}
+        yield decorate_answer(answer)
+    else:
+        answer = chat_mdl.chat(system, msg, gen_conf)
+        yield decorate_answer(answer)
 
 
 def use_sql(question, field_map, tenant_id, chat_mdl, quota=True):
@@ -20,6 +20,7 @@ from elasticsearch_dsl import Q
 from api.utils import current_timestamp
 from rag.utils.es_conn import ELASTICSEARCH
 from rag.utils.minio_conn import MINIO
+from rag.utils.retrieval_cache import bump_kb_version
 from rag.nlp import search
 
 from api.db import FileType, TaskStatus
@@ -134,6 +135,9 @@ class DocumentService(CommonService):
     @classmethod
     @DB.connection_context()
     def increment_chunk_num(cls, doc_id, kb_id, token_num, chunk_num, duation):
+        # to be called once the chunks are indexed or deleted, so that the
+        # cached retrievals and answers of the knowledgebase are dropped
+        bump_kb_version(kb_id)
         num = cls.model.update(token_num=cls.model.token_num + token_num,
                                chunk_num=cls.model.chunk_num + chunk_num,
                                process_duation=cls.model.process_duation + duation).where(
@@ -16,6 +16,7 @@
 from api.db.services.user_service import TenantService
 from api.settings import database_logger
 from rag.llm import EmbeddingModel, CvModel, ChatModel
+from rag.utils.embedding_cache import QUERY_EMBEDDING_CACHE
 from api.db import LLMType
 from api.db.db_models import DB, UserTenant
 from api.db.db_models import LLMFactories, LLM, TenantLLM
@@ -153,13 +154,36 @@ class LLMBundle(object):
         return emd, used_tokens
 
     def encode_queries(self, query: str):
+        mdl_nm = getattr(self.mdl, "model_name", self.llm_name)
+        emd = QUERY_EMBEDDING_CACHE.get(self.mdl.__class__.__name__, mdl_nm, query)
+        if emd is not None:
+            return emd, 0
         emd, used_tokens = self.mdl.encode_queries(query)
+        QUERY_EMBEDDING_CACHE.put(self.mdl.__class__.__name__, mdl_nm, query, emd)
         if not TenantLLMService.increase_usage(
                 self.tenant_id, self.llm_type, used_tokens):
             database_logger.error(
                 "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
         return emd, used_tokens
 
+    def encode_queries_batch(self, queries: list):
+        """encode_queries of every query, the ones not cached in one model call."""
+        cls_nm = self.mdl.__class__.__name__
+        mdl_nm = getattr(self.mdl, "model_name", self.llm_name)
+        embds = [QUERY_EMBEDDING_CACHE.get(cls_nm, mdl_nm, q) for q in queries]
+        todo = [i for i, e in enumerate(embds) if e is None]
+        used_tokens = 0
+        if todo:
+            vs, used_tokens = self.mdl.encode_queries_batch([queries[i] for i in todo])
+            for i, v in zip(todo, vs):
+                embds[i] = v
+                QUERY_EMBEDDING_CACHE.put(cls_nm, mdl_nm, queries[i], v)
+            if not TenantLLMService.increase_usage(
+                    self.tenant_id, self.llm_type, used_tokens):
+                database_logger.error(
+                    "Can't update token usage for {}/EMBEDDING".format(self.tenant_id))
+        return embds, used_tokens
+
     def describe(self, image, max_tokens=300):
         txt, used_tokens = self.mdl.describe(image, max_tokens)
         if not TenantLLMService.increase_usage(
@@ -175,3 +199,13 @@ class LLMBundle(object):
             database_logger.error(
                 "Can't update token usage for {}/CHAT".format(self.tenant_id))
         return txt
+
+    def chat_streamly(self, system, history, gen_conf):
+        for txt in self.mdl.chat_streamly(system, history, gen_conf):
+            if isinstance(txt, int):
+                if not TenantLLMService.increase_usage(
+                        self.tenant_id, self.llm_type, txt, self.llm_name):
+                    database_logger.error(
+                        "Can't update token usage for {}/CHAT".format(self.tenant_id))
+                return
+            yield txt
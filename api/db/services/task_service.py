@@ -71,6 +71,48 @@ class TaskService(CommonService):
                 cls.model.id == docs[0]["id"]).execute()
             return docs
 
+    @classmethod
+    @DB.connection_context()
+    def get_task(cls, task_id):
+        """Take the task delivered by the task queue. No global lock is needed since
+        the queue hands out every message to exactly one consumer."""
+        fields = [
+            cls.model.id,
+            cls.model.doc_id,
+            cls.model.from_page,
+            cls.model.to_page,
+            Document.kb_id,
+            Document.parser_id,
+            Document.parser_config,
+            Document.name,
+            Document.type,
+            Document.location,
+            Document.size,
+            Knowledgebase.tenant_id,
+            Knowledgebase.language,
+            Knowledgebase.embd_id,
+            Tenant.img2txt_id,
+            Tenant.asr_id,
+            cls.model.update_time]
+        docs = cls.model.select(*fields) \
+            .join(Document, on=(cls.model.doc_id == Document.id)) \
+            .join(Knowledgebase, on=(Document.kb_id == Knowledgebase.id)) \
+            .join(Tenant, on=(Knowledgebase.tenant_id == Tenant.id)) \
+            .where(
+                cls.model.id == task_id,
+                Document.status == StatusEnum.VALID.value,
+                Document.run == TaskStatus.RUNNING.value,
+                ~(Document.type == FileType.VIRTUAL.value),
+                cls.model.progress >= 0,
+                cls.model.progress < 1)
+        docs = list(docs.dicts())
+        if not docs: return []
+
+        cls.model.update(progress_msg=cls.model.progress_msg + "\n" + "Task has been received.",
+                         progress=random.random() / 10.).where(
+            cls.model.id == docs[0]["id"]).execute()
+        return docs
+
     @classmethod
     @DB.connection_context()
     def get_ongoing_doc_name(cls):
@@ -30,6 +30,8 @@ from api import utils
 from api.db.db_models import init_database_tables as init_web_db
 from api.db.init_data import init_web_data
 from api.versions import get_versions
+from rag.settings import WARMUP
+from rag.utils.model_registry import MODEL_REGISTRY, startup_report
 
 if __name__ == '__main__':
     print("""
@@ -71,6 +73,9 @@ if __name__ == '__main__':
     peewee_logger.addHandler(database_logger.handlers[0])
     peewee_logger.setLevel(database_logger.level)
 
+    MODEL_REGISTRY.warmup(WARMUP.get("api", ["elasticsearch", "huqie"]))
+    startup_report("RAG Flow http server")
+
     # start http server
     try:
         stat_logger.info("RAG Flow http server start...")
@@ -221,6 +221,17 @@ def get_json_result(retcode=RetCode.SUCCESS, retmsg='success', data=None):
     return jsonify(response)
 
 
+def sse_data(retcode=RetCode.SUCCESS, retmsg='', data=None):
+    return "data:" + json_dumps({"retcode": retcode, "retmsg": retmsg, "data": data}) + "\n\n"
+
+
+def sse_response(events):
+    response = Response(events, mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 def cors_reponse(retcode=RetCode.SUCCESS,
                  retmsg='success', data=None, auth=None):
     result_dict = {"retcode": retcode, "retmsg": retmsg, "data": data}
@@ -0,0 +1,104 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+
+class PageImageCache(object):
+    """
+    List-like holder of rendered page images which keeps at most `window` of
+    them in memory. The least recently used ones are spilled into a temporary
+    directory as lossless PNG, or dropped and rendered again by
+    `renderer(page_index)` if a renderer is given.
+
+    It stands for the plain list in `RAGFlowPdfParser.page_images`, so
+    `crop()`, the layout and the table stages read it without any change.
+    """
+
+    def __init__(self, window=4, renderer=None):
+        self.window = max(1, int(window))
+        self.renderer = renderer
+        self._mem = OrderedDict()
+        self._spilled = {}
+        self._size = 0
+        self._dir = None
+        self._lock = threading.RLock()
+
+    def append(self, img):
+        with self._lock:
+            self._size += 1
+            self._keep(self._size - 1, img)
+
+    def _keep(self, i, img):
+        self._mem[i] = img
+        self._mem.move_to_end(i)
+        while len(self._mem) > self.window:
+            j, im = self._mem.popitem(last=False)
+            if self.renderer is None and j not in self._spilled:
+                self._spill(j, im)
+
+    def _spill(self, i, img):
+        if not self._dir:
+            self._dir = tempfile.mkdtemp(prefix="ragflow_pages_")
+        path = os.path.join(self._dir, "%d.png" % i)
+        img.save(path, format="PNG", compress_level=1)
+        self._spilled[i] = path
+
+    def _load(self, i):
+        if i in self._spilled:
+            with Image.open(self._spilled[i]) as im:
+                im.load()
+                return im.copy()
+        return self.renderer(i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self._size))]
+        if i < 0:
+            i += self._size
+        if i < 0 or i >= self._size:
+            raise IndexError("page image index out of range")
+        with self._lock:
+            if i in self._mem:
+                self._mem.move_to_end(i)
+                return self._mem[i]
+            img = self._load(i)
+            self._keep(i, img)
+            return img
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield self[i]
+
+    def close(self):
+        with self._lock:
+            self._mem.clear()
+            self._spilled = {}
+            if self._dir:
+                shutil.rmtree(self._dir, ignore_errors=True)
+                self._dir = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception as e:
+            pass
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
+import math
+import multiprocessing
 import os
 import random
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import xgboost as xgb
 from io import BytesIO
@@ -15,8 +20,13 @@ from PyPDF2 import PdfReader as pdf2_read
 
 from api.utils.file_utils import get_project_base_directory
 from deepdoc.vision import OCR, Recognizer, LayoutRecognizer, TableStructureRecognizer
+from rag.utils.model_registry import MODEL_REGISTRY
+from deepdoc.vision.box_array import BoxArray
+from deepdoc.parser.page_cache import PageImageCache
 from rag.nlp import rag_tokenizer
+from rag.settings import DEEPDOC
 from copy import deepcopy
+from functools import partial
 from huggingface_hub import snapshot_download
 
 logging.getLogger("pdfminer").setLevel(logging.WARNING)
@@ -24,29 +34,15 @@ logging.getLogger("pdfminer").setLevel(logging.WARNING)
 
 class RAGFlowPdfParser:
     def __init__(self):
-        self.ocr = OCR()
+        # The models are borrowed from the process-wide registry, so only the
+        # first parser of a species pays for loading them.
+        self.ocr = MODEL_REGISTRY.get("ocr", OCR)
+        layout_species = "layout"
         if hasattr(self, "model_speciess"):
-            self.layouter = LayoutRecognizer("layout." + self.model_speciess)
-        else:
-            self.layouter = LayoutRecognizer("layout")
-        self.tbl_det = TableStructureRecognizer()
-
-        self.updown_cnt_mdl = xgb.Booster()
-        if torch.cuda.is_available():
-            self.updown_cnt_mdl.set_param({"device": "cuda"})
-        try:
-            model_dir = os.path.join(
-                get_project_base_directory(),
-                "rag/res/deepdoc")
-            self.updown_cnt_mdl.load_model(os.path.join(
-                model_dir, "updown_concat_xgb.model"))
-        except Exception as e:
-            model_dir = snapshot_download(
-                repo_id="InfiniFlow/text_concat_xgb_v1.0",
-                local_dir=os.path.join(get_project_base_directory(), "rag/res/deepdoc"),
-                local_dir_use_symlinks=False)
-            self.updown_cnt_mdl.load_model(os.path.join(
-                model_dir, "updown_concat_xgb.model"))
+            layout_species = "layout." + self.model_speciess
+        self.layouter = MODEL_REGISTRY.get(layout_species, partial(LayoutRecognizer, layout_species))
+        self.tbl_det = MODEL_REGISTRY.get("tsr", TableStructureRecognizer)
+        self.updown_cnt_mdl = MODEL_REGISTRY.get("updown_concat_xgb", RAGFlowPdfParser.load_updown_cnt_mdl)
 
         self.page_from = 0
         """
@@ -61,6 +57,37 @@ class RAGFlowPdfParser:
 
         """
 
+    @staticmethod
+    def load_updown_cnt_mdl():
+        mdl = xgb.Booster()
+        if torch.cuda.is_available():
+            mdl.set_param({"device": "cuda"})
+        try:
+            model_dir = os.path.join(
+                get_project_base_directory(),
+                "rag/res/deepdoc")
+            mdl.load_model(os.path.join(
+                model_dir, "updown_concat_xgb.model"))
+        except Exception as e:
+            model_dir = snapshot_download(
+                repo_id="InfiniFlow/text_concat_xgb_v1.0",
+                local_dir=os.path.join(get_project_base_directory(), "rag/res/deepdoc"),
+                local_dir_use_symlinks=False)
+            mdl.load_model(os.path.join(
+                model_dir, "updown_concat_xgb.model"))
+        return mdl
+
+    @classmethod
+    def warmup(cls, model_speciess=None):
+        """Load the models of a parser species ahead of the first document."""
+        layout_species = "layout." + model_speciess if model_speciess else "layout"
+        MODEL_REGISTRY.warmup({
+            "ocr": OCR,
+            layout_species: partial(LayoutRecognizer, layout_species),
+            "tsr": TableStructureRecognizer,
+            "updown_concat_xgb": cls.load_updown_cnt_mdl
+        })
+
     def __char_width(self, c):
         return (c["x1"] - c["x0"]) // max(len(c["text"]), 1)
 
@@ -228,17 +255,17 @@ class RAGFlowPdfParser:
         clmns = sorted([r for r in self.tb_cpns if re.match(
             r"table column$", r["label"])], key=lambda x: (x["pn"], x["layoutno"], x["x0"]))
         clmns = Recognizer.layouts_cleanup(self.boxes, clmns, 5, 0.5)
+        rows_arr, headers_arr, spans_arr = BoxArray(rows), BoxArray(headers), BoxArray(spans)
         for b in self.boxes:
             if b.get("layout_type", "") != "table":
                 continue
-            ii = Recognizer.find_overlapped_with_threashold(b, rows, thr=0.3)
+            ii = rows_arr.find_overlapped_with_threashold(b, thr=0.3)
             if ii is not None:
                 b["R"] = ii
                 b["R_top"] = rows[ii]["top"]
                 b["R_bott"] = rows[ii]["bottom"]
 
-            ii = Recognizer.find_overlapped_with_threashold(
-                b, headers, thr=0.3)
+            ii = headers_arr.find_overlapped_with_threashold(b, thr=0.3)
             if ii is not None:
                 b["H_top"] = headers[ii]["top"]
                 b["H_bott"] = headers[ii]["bottom"]
@@ -252,7 +279,7 @@ class RAGFlowPdfParser:
                 b["C_left"] = clmns[ii]["x0"]
                 b["C_right"] = clmns[ii]["x1"]
 
-            ii = Recognizer.find_overlapped_with_threashold(b, spans, thr=0.3)
+            ii = spans_arr.find_overlapped_with_threashold(b, thr=0.3)
             if ii is not None:
                 b["H_top"] = spans[ii]["top"]
                 b["H_bott"] = spans[ii]["bottom"]
@@ -260,31 +287,32 @@ class RAGFlowPdfParser:
                 b["H_right"] = spans[ii]["x1"]
                 b["SP"] = ii
 
-    def __ocr(self, pagenum, img, chars, ZM=3):
+    def __ocr(self, pagenum, img, chars, ZM=3, mean_height=0, mean_width=8):
+        lefted_chars = []
         bxs = self.ocr.detect(np.array(img))
         if not bxs:
-            self.boxes.append([])
-            return
+            return [], lefted_chars, mean_height
         bxs = [(line[0], line[1][0]) for line in bxs]
         bxs = Recognizer.sort_Y_firstly(
             [{"x0": b[0][0] / ZM, "x1": b[1][0] / ZM,
               "top": b[0][1] / ZM, "text": "", "txt": t,
               "bottom": b[-1][1] / ZM,
               "page_number": pagenum} for b, t in bxs if b[0][0] <= b[1][0] and b[0][1] <= b[-1][1]],
-            self.mean_height[-1] / 3
+            mean_height / 3
         )
 
         # merge chars in the same rect
+        bxs_arr = BoxArray(bxs)
         for c in Recognizer.sort_X_firstly(
-                chars, self.mean_width[pagenum - 1] // 4):
-            ii = Recognizer.find_overlapped(c, bxs)
+                chars, mean_width // 4):
+            ii = bxs_arr.find_overlapped(c)
             if ii is None:
-                self.lefted_chars.append(c)
+                lefted_chars.append(c)
                 continue
             ch = c["bottom"] - c["top"]
             bh = bxs[ii]["bottom"] - bxs[ii]["top"]
             if abs(ch - bh) / max(ch, bh) >= 0.7 and c["text"] != ' ':
-                self.lefted_chars.append(c)
+                lefted_chars.append(c)
                 continue
             if c["text"] == " " and bxs[ii]["text"]:
                 if re.match(r"[0-9a-zA-Z,.?;:!%%]", bxs[ii]["text"][-1]):
@@ -292,20 +320,89 @@ class RAGFlowPdfParser:
             else:
                 bxs[ii]["text"] += c["text"]
 
+        # boxes without embedded text are recognized by batches
+        boxes_to_reg = []
         for b in bxs:
             if not b["text"]:
                 left, right, top, bott = b["x0"] * ZM, b["x1"] * \
                                          ZM, b["top"] * ZM, b["bottom"] * ZM
-                b["text"] = self.ocr.recognize(np.array(img),
-                                               np.array([[left, top], [right, top], [right, bott], [left, bott]],
-                                                        dtype=np.float32))
+                boxes_to_reg.append((b, np.array([[left, top], [right, top], [right, bott], [left, bott]],
+                                                 dtype=np.float32)))
             del b["txt"]
+        if boxes_to_reg:
+            texts = self.ocr.recognize_batch(np.array(img), [box for _, box in boxes_to_reg])
+            for (b, _), txt in zip(boxes_to_reg, texts):
+                b["text"] = txt
         bxs = [b for b in bxs if b["text"]]
-        if self.mean_height[-1] == 0:
-            self.mean_height[-1] = np.median([b["bottom"] - b["top"]
-                                              for b in bxs])
+        if mean_height == 0:
+            mean_height = np.median([b["bottom"] - b["top"]
+                                     for b in bxs])
+        return bxs, lefted_chars, mean_height
+
+    def _ocr_page(self, pagenum, img, chars, ZM=3):
+        """
+        OCR of a single page, which only depends on `self.ocr`.
+        Returns the boxes, the chars out of any box, the mean height and the mean width of the page.
+        """
+        mean_height = np.median(sorted([c["height"] for c in chars])) if chars else 0
+        mean_width = np.median(sorted([c["width"] for c in chars])) if chars else 8
+        j = 0
+        while j + 1 < len(chars):
+            if chars[j]["text"] and chars[j + 1]["text"] \
+                    and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
+                    and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
+                                                                   chars[j]["width"]) / 2:
+                chars[j]["text"] += " "
+            j += 1
+
+        bxs, lefted_chars, mean_height = self.__ocr(pagenum, img, chars, ZM, mean_height, mean_width)
+        return bxs, lefted_chars, mean_height, mean_width
+
+    def __append_page(self, img, bxs, lefted_chars, mean_height, mean_width, ZM=3):
+        self.mean_height.append(mean_height)
+        self.mean_width.append(mean_width)
+        self.page_cum_height.append(img.size[1] / ZM)
+        self.lefted_chars.extend(lefted_chars)
         self.boxes.append(bxs)
 
+    def __parallel_ocr(self, fnm, zoomin, page_from, callback=None):
+        """
+        Rasterize and OCR the pages in the process pool, where every worker
+        holds its own ONNX sessions. Pages are handed out in contiguous runs
+        and appended to `self.page_images` in page order. With a page_window,
+        at most `window` pages are being OCRed at a time.
+        """
+        pool = _ocr_pool()
+        page_num = len(self.page_chars)
+        run = max(1, math.ceil(page_num / (pool._max_workers * 2)))
+        window = int(DEEPDOC.get("page_window", 0))
+        in_flight = page_num
+        if window:
+            run = min(run, window)
+            in_flight = max(1, window // run)
+
+        def submit(i):
+            pages = list(range(i, min(i + run, page_num)))
+            return pool.submit(_ocr_pages_job, fnm, zoomin, page_from, pages,
+                               [self.page_chars[p] if not self.is_english else [] for p in pages])
+
+        starts = iter(range(0, page_num, run))
+        futs = deque(submit(i) for _, i in zip(range(in_flight), starts))
+        # the runs are contiguous, so merging them in submission order keeps page order;
+        # a run's images are dropped once merged
+        done = 0
+        while futs:
+            res = futs.popleft().result()
+            i = next(starts, None)
+            if i is not None:
+                futs.append(submit(i))
+            for i, img, bxs, lefted_chars, mean_height, mean_width in res:
+                self.page_images.append(img)
+                self.__append_page(img, bxs, lefted_chars, mean_height, mean_width, zoomin)
+                done += 1
+            if callback:
+                callback(prog=done * 0.6 / page_num, msg="")
+
     def _layouts_rec(self, ZM, drop=True):
         assert len(self.page_images) == len(self.boxes)
         self.boxes, self.page_layout = self.layouter(
@@ -934,11 +1031,28 @@ class RAGFlowPdfParser:
         self.page_layout = []
         self.page_from = page_from
         st = timer()
+        parallel = DEEPDOC.get("parallel_ocr", False)
+        window = int(DEEPDOC.get("page_window", 0))
+        page_renders = []
         try:
             self.pdf = pdfplumber.open(fnm) if isinstance(
                 fnm, str) else pdfplumber.open(BytesIO(fnm))
-            self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
-                                enumerate(self.pdf.pages[page_from:page_to])]
+            parallel = parallel and len(self.pdf.pages[page_from:page_to]) > 1
+            self.page_images = []
+            if window:
+                # pages are rendered one by one along the OCR, only `window` of them stay in memory
+                pdf = self.pdf
+                renderer = None
+                if DEEPDOC.get("page_spill", "disk") == "render":
+                    renderer = lambda i: pdf.pages[page_from + i].to_image(resolution=72 * zoomin).annotated
+                self.page_images = PageImageCache(window, renderer)
+                page_renders = (p.to_image(resolution=72 * zoomin).annotated for p in
+                                self.pdf.pages[page_from:page_to])
+            elif not parallel:
+                # rendered by the OCR workers otherwise
+                self.page_images = [p.to_image(resolution=72 * zoomin).annotated for i, p in
+                                    enumerate(self.pdf.pages[page_from:page_to])]
+                page_renders = self.page_images
             self.page_chars = [[c for c in page.chars if self._has_color(c)] for page in
                                self.pdf.pages[page_from:page_to]]
             self.total_page = len(self.pdf.pages)
@@ -968,34 +1082,23 @@ class RAGFlowPdfParser:
             random.choices([c["text"] for c in self.page_chars[i]], k=min(100, len(self.page_chars[i]))))) for i in
                            range(len(self.page_chars))]
         if sum([1 if e else 0 for e in self.is_english]) > len(
-                self.page_images) / 2:
+                self.page_chars) / 2:
             self.is_english = True
         else:
             self.is_english = False
         self.is_english = False
 
         st = timer()
-        for i, img in enumerate(self.page_images):
-            chars = self.page_chars[i] if not self.is_english else []
-            self.mean_height.append(
-                np.median(sorted([c["height"] for c in chars])) if chars else 0
-            )
-            self.mean_width.append(
-                np.median(sorted([c["width"] for c in chars])) if chars else 8
-            )
-            self.page_cum_height.append(img.size[1] / zoomin)
-            j = 0
-            while j + 1 < len(chars):
-                if chars[j]["text"] and chars[j + 1]["text"] \
-                        and re.match(r"[0-9a-zA-Z,.:;!%]+", chars[j]["text"] + chars[j + 1]["text"]) \
-                        and chars[j + 1]["x0"] - chars[j]["x1"] >= min(chars[j + 1]["width"],
-                                                                       chars[j]["width"]) / 2:
-                    chars[j]["text"] += " "
-                j += 1
-
-            self.__ocr(i + 1, img, chars, zoomin)
-            if callback and i % 6 == 5:
-                callback(prog=(i + 1) * 0.6 / len(self.page_images), msg="")
+        if parallel:
+            self.__parallel_ocr(fnm, zoomin, page_from, callback)
+        else:
+            for i, img in enumerate(page_renders):
+                if window:
+                    self.page_images.append(img)
+                chars = self.page_chars[i] if not self.is_english else []
+                self.__append_page(img, *self._ocr_page(i + 1, img, chars, zoomin), zoomin)
+                if callback and i % 6 == 5:
+                    callback(prog=(i + 1) * 0.6 / len(self.page_chars), msg="")
         # print("OCR:", timer()-st)
 
         if not self.is_english and not any(
@@ -1120,6 +1223,41 @@ class RAGFlowPdfParser:
         return poss
 
 
+# so that a process can warm them up by species, see WARMUP in rag/settings.py
+MODEL_REGISTRY.register("ocr", OCR)
+MODEL_REGISTRY.register("layout", partial(LayoutRecognizer, "layout"))
+MODEL_REGISTRY.register("tsr", TableStructureRecognizer)
+MODEL_REGISTRY.register("updown_concat_xgb", RAGFlowPdfParser.load_updown_cnt_mdl)
+
+_OCR_POOL = None
+_OCR_POOL_LOCK = threading.Lock()
+
+
+def _ocr_pool():
+    global _OCR_POOL
+    with _OCR_POOL_LOCK:
+        if _OCR_POOL is None:
+            _OCR_POOL = ProcessPoolExecutor(
+                max_workers=int(DEEPDOC.get("ocr_workers", 0)) or os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context("spawn"))
+        return _OCR_POOL
+
+
+def _ocr_pages_job(fnm, zoomin, page_from, pages, page_chars):
+    # Only the OCR model is needed by _ocr_page, so the parser is not fully
+    # initialized in the workers.
+    parser = RAGFlowPdfParser.__new__(RAGFlowPdfParser)
+    parser.ocr = MODEL_REGISTRY.get("ocr", OCR)
+    pdf = pdfplumber.open(fnm) if isinstance(
+        fnm, str) else pdfplumber.open(BytesIO(fnm))
+    res = []
+    for i, chars in zip(pages, page_chars):
+        img = pdf.pages[page_from + i].to_image(resolution=72 * zoomin).annotated
+        res.append((i, img, *parser._ocr_page(i + 1, img, chars, zoomin)))
+    pdf.close()
+    return res
+
+
 class PlainParser(object):
     def __call__(self, filename, from_page=0, to_page=100000, **kwargs):
         self.outlines = []
@@ -0,0 +1,143 @@
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import numpy as np
+
+
+def iou_matrix(a, b):
+    """IoU of every pair of [x0, y0, x1, y1] boxes in `a` (n*4) and `b` (m*4)."""
+    x0 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y0 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x1 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y1 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.maximum(0, x1 - x0) * np.maximum(0, y1 - y0)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+def nms(boxes, scores, iou_threshold, class_ids=None):
+    """
+    Greedy non-maximum suppression over [x0, y0, x1, y1] boxes. Boxes of
+    different `class_ids` never suppress each other.
+    The kept indices are grouped by ascending class id, by descending score within a class.
+    """
+    if len(boxes) == 0:
+        return []
+    if class_ids is None:
+        class_ids = np.zeros(len(boxes), dtype=np.int64)
+    order = np.argsort(scores)[::-1]
+    ious = iou_matrix(boxes[order], boxes[order])
+    same_class = class_ids[order][:, None] == class_ids[order][None, :]
+    # box i suppresses box j if i is kept and ranks before j
+    # NaN (degenerate boxes) suppresses too, as `ious < iou_threshold` is false for it
+    suppress = ~(ious < iou_threshold) & same_class
+    np.fill_diagonal(suppress, False)
+    suppress = np.triu(suppress)
+    keep = np.ones(len(order), dtype=bool)
+    for i in range(len(order)):
+        if keep[i]:
+            keep[i + 1:] &= ~suppress[i, i + 1:]
+    kept = order[keep]
+    return kept[np.argsort(class_ids[kept], kind="stable")].tolist()
+
+
+class BoxArray(object):
+    """
+    NumPy-backed view on a list of box dicts (x0, x1, top, bottom) for the
+    overlap queries of Recognizer. The boxes are indexed by `top`, so a query
+    only looks at the boxes overlapping it vertically instead of scanning the
+    whole list.
+
+    The positions are read once at construction: build it after the boxes
+    have stopped moving.
+    """
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+        n = len(boxes)
+        self.x0 = np.fromiter((b["x0"] for b in boxes), dtype=np.float64, count=n)
+        self.x1 = np.fromiter((b["x1"] for b in boxes), dtype=np.float64, count=n)
+        self.top = np.fromiter((b["top"] for b in boxes), dtype=np.float64, count=n)
+        self.bottom = np.fromiter((b["bottom"] for b in boxes), dtype=np.float64, count=n)
+        self._by_top = np.argsort(self.top, kind="stable")
+        self._sorted_top = self.top[self._by_top]
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def candidates(self, box):
+        """Indices, in list order, of the boxes overlapping `box` along both axes."""
+        e = np.searchsorted(self._sorted_top, box["bottom"], side="right")
+        idx = self._by_top[:e]
+        idx = idx[(self.bottom[idx] >= box["top"])
+                  & (self.x0[idx] <= box["x1"]) & (self.x1[idx] >= box["x0"])]
+        return np.sort(idx)
+
+    def _intersection(self, idx, box):
+        w = np.minimum(self.x1[idx], box["x1"]) - np.maximum(self.x0[idx], box["x0"])
+        h = np.minimum(self.bottom[idx], box["bottom"]) - np.maximum(self.top[idx], box["top"])
+        return w * h
+
+    def overlapped_area(self, idx, box, ratio=True):
+        """Recognizer.overlapped_area(self.boxes[i], box) for i in idx."""
+        w = self.x1[idx] - self.x0[idx]
+        h = self.bottom[idx] - self.top[idx]
+        ov = np.where((w != 0) & (h != 0), self._intersection(idx, box), 0)
+        if ratio:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ov = np.where(ov > 0, ov / (w * h), ov)
+        return ov
+
+    def overlapped_area_of(self, idx, box, ratio=True):
+        """Recognizer.overlapped_area(box, self.boxes[i]) for i in idx."""
+        w, h = box["x1"] - box["x0"], box["bottom"] - box["top"]
+        if w == 0 or h == 0:
+            return np.zeros(len(idx))
+        ov = self._intersection(idx, box)
+        if ratio:
+            ov = np.where(ov > 0, ov / (w * h), ov)
+        return ov
+
+    def find_overlapped(self, box):
+        """The box covering the largest share of itself with `box`, as Recognizer.find_overlapped."""
+        idx = self.candidates(box)
+        if not len(idx):
+            return
+        ov = self.overlapped_area(idx, box)
+        i = int(np.argmax(ov))
+        if ov[i] <= 0:
+            return
+        return int(idx[i])
+
+    def find_overlapped_with_threashold(self, box, thr=0.3):
+        """Same pick as Recognizer.find_overlapped_with_threashold: the largest
+        (overlap of box, overlap of the candidate) not less than (thr, 0), the last one on ties."""
+        idx = self.candidates(box)
+        if not len(idx):
+            return
+        ov = self.overlapped_area_of(idx, box)
+        _ov = self.overlapped_area(idx, box)
+        m = ov >= thr
+        if not m.any():
+            return
+        idx, ov, _ov = idx[m], ov[m], _ov[m]
+        return int(idx[np.lexsort((idx, _ov, ov))[-1]])
+
+    def intersection_area_sum(self, box):
+        """sum(Recognizer.overlapped_area(b, box, False) for b in self.boxes)"""
+        idx = self.candidates(box)
+        if not len(idx):
+            return 0
+        return float(np.sum(self.overlapped_area(idx, box, ratio=False)))
@@ -23,7 +23,7 @@ import numpy as np
 import onnxruntime as ort
 
 from .postprocess import build_post_process
-from rag.settings import cron_logger
+from rag.settings import cron_logger, DEEPDOC
 
 
 def transform(data, ops=None):
@@ -68,8 +68,8 @@ def load_model(model_dir, nm):
     options = ort.SessionOptions()
     options.enable_cpu_mem_arena = False
     options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
-    options.intra_op_num_threads = 2
-    options.inter_op_num_threads = 2
+    options.intra_op_num_threads = int(DEEPDOC.get("ocr_intra_op_num_threads", 2))
+    options.inter_op_num_threads = int(DEEPDOC.get("ocr_inter_op_num_threads", 2))
     if False and ort.get_device() == "GPU":
         sess = ort.InferenceSession(
             model_file_path,
@@ -582,6 +582,19 @@ class OCR(object):
             return ""
         return text
 
+    def recognize_batch(self, ori_im, boxes):
+        """
+        Recognize all the boxes of an image in one go. The crops are fed into
+        the text recognizer in width-sorted batches of `rec_batch_num`.
+        """
+        img_crops = [self.get_rotate_crop_image(ori_im, box) for box in boxes]
+        if not img_crops:
+            return []
+        rec_res, elapse = self.text_recognizer(img_crops)
+        cron_logger.debug("rec_res num  : {}, elapsed : {}".format(
+            len(rec_res), elapse))
+        return [text if score >= self.drop_score else "" for text, score in rec_res]
+
     def __call__(self, img, cls=True):
         time_dict = {'det': 0, 'rec': 0, 'cls': 0, 'all': 0}
 
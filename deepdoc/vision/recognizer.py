@@ -19,7 +19,8 @@ from huggingface_hub import snapshot_download
 
 from api.utils.file_utils import get_project_base_directory
 from .operators import *
-from rag.settings import cron_logger
+from .box_array import BoxArray, nms
+from rag.settings import cron_logger, DEEPDOC
 
 
 class Recognizer(object):
@@ -51,15 +52,20 @@ class Recognizer(object):
         if not os.path.exists(model_file_path):
             raise ValueError("not find model file path {}".format(
                 model_file_path))
+        options = ort.SessionOptions()
+        # 0 lets onnxruntime decide
+        options.intra_op_num_threads = int(DEEPDOC.get("intra_op_num_threads", 0))
+        options.inter_op_num_threads = int(DEEPDOC.get("inter_op_num_threads", 0))
         if False and ort.get_device() == "GPU":
-            options = ort.SessionOptions()
             options.enable_cpu_mem_arena = False
-            self.ort_sess = ort.InferenceSession(model_file_path, options=options, providers=[('CUDAExecutionProvider')])
+            self.ort_sess = ort.InferenceSession(model_file_path, sess_options=options, providers=[('CUDAExecutionProvider')])
         else:
-            self.ort_sess = ort.InferenceSession(model_file_path, providers=['CPUExecutionProvider'])
+            self.ort_sess = ort.InferenceSession(model_file_path, sess_options=options, providers=['CPUExecutionProvider'])
         self.input_names = [node.name for node in self.ort_sess.get_inputs()]
         self.output_names = [node.name for node in self.ort_sess.get_outputs()]
         self.input_shape = self.ort_sess.get_inputs()[0].shape[2:4]
+        # a symbolic first dimension means the model takes a whole batch in one run
+        self.dynamic_batch = not isinstance(self.ort_sess.get_inputs()[0].shape[0], int)
         self.label_list = label_list
 
     @staticmethod
@@ -160,6 +166,7 @@ class Recognizer(object):
                         a["bottom"] < b["top"],
                         a["top"] > b["bottom"]])
 
+        boxes_arr = None
         i = 0
         while i + 1 < len(layouts):
             j = i + 1
@@ -182,12 +189,10 @@ class Recognizer(object):
                     layouts.pop(i)
                 continue
 
-            area_i, area_i_1 = 0, 0
-            for b in boxes:
-                if not notOverlapped(b, layouts[i]):
-                    area_i += Recognizer.overlapped_area(b, layouts[i], False)
-                if not notOverlapped(b, layouts[j]):
-                    area_i_1 += Recognizer.overlapped_area(b, layouts[j], False)
+            if boxes_arr is None:
+                boxes_arr = BoxArray(boxes)
+            area_i = boxes_arr.intersection_area_sum(layouts[i])
+            area_i_1 = boxes_arr.intersection_area_sum(layouts[j])
 
             if area_i > area_i_1:
                 layouts.pop(j)
@@ -358,46 +363,6 @@ class Recognizer(object):
             y[:, 3] = x[:, 1] + x[:, 3] / 2
             return y
 
-        def compute_iou(box, boxes):
-            # Compute xmin, ymin, xmax, ymax for both boxes
-            xmin = np.maximum(box[0], boxes[:, 0])
-            ymin = np.maximum(box[1], boxes[:, 1])
-            xmax = np.minimum(box[2], boxes[:, 2])
-            ymax = np.minimum(box[3], boxes[:, 3])
-
-            # Compute intersection area
-            intersection_area = np.maximum(0, xmax - xmin) * np.maximum(0, ymax - ymin)
-
-            # Compute union area
-            box_area = (box[2] - box[0]) * (box[3] - box[1])
-            boxes_area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
-            union_area = box_area + boxes_area - intersection_area
-
-            # Compute IoU
-            iou = intersection_area / union_area
-
-            return iou
-
-        def iou_filter(boxes, scores, iou_threshold):
-            sorted_indices = np.argsort(scores)[::-1]
-
-            keep_boxes = []
-            while sorted_indices.size > 0:
-                # Pick the last box
-                box_id = sorted_indices[0]
-                keep_boxes.append(box_id)
-
-                # Compute IoU of the picked box with the rest
-                ious = compute_iou(boxes[box_id, :], boxes[sorted_indices[1:], :])
-
-                # Remove boxes with IoU over the threshold
-                keep_indices = np.where(ious < iou_threshold)[0]
-
-                # print(keep_indices.shape, sorted_indices.shape)
-                sorted_indices = sorted_indices[keep_indices + 1]
-
-            return keep_boxes
-
         boxes = np.squeeze(boxes).T
         # Filter out object confidence scores below threshold
         scores = np.max(boxes[:, 4:], axis=1)
@@ -412,14 +377,7 @@ class Recognizer(object):
         boxes = np.multiply(boxes, input_shape, dtype=np.float32)
         boxes = xywh2xyxy(boxes)
 
-        unique_class_ids = np.unique(class_ids)
-        indices = []
-        for class_id in unique_class_ids:
-            class_indices = np.where(class_ids == class_id)[0]
-            class_boxes = boxes[class_indices, :]
-            class_scores = scores[class_indices]
-            class_keep_boxes = iou_filter(class_boxes, class_scores, 0.2)
-            indices.extend(class_indices[class_keep_boxes])
+        indices = nms(boxes, scores, 0.2, class_ids)
 
         return [{
             "type": self.label_list[class_ids[i]].lower(),
@@ -427,23 +385,45 @@ class Recognizer(object):
             "score": float(scores[i])
         } for i in indices]
 
+    def run_batch(self, inputs):
+        """
+        Runs the preprocessed inputs of a batch and returns the first output of every image.
+        The inputs are stacked into one tensor for the models with a dynamic batch
+        dimension, fixed-shape models fall back to one run per image.
+        """
+        def one_by_one():
+            return [self.ort_sess.run(None, {k: v for k, v in ins.items() if k in self.input_names})[0]
+                    for ins in inputs]
+
+        names = [k for k in self.input_names if k in inputs[0]]
+        if not self.dynamic_batch or len(inputs) < 2 \
+                or any([len(set([ins[k].shape for ins in inputs])) > 1 for k in names]):
+            return one_by_one()
+
+        outputs = self.ort_sess.run(None, {k: np.concatenate([ins[k] for ins in inputs], axis=0) for k in names})
+        if "scale_factor" not in self.input_names:
+            return [outputs[0][i:i + 1] for i in range(len(inputs))]
+        # boxes of the whole batch come concatenated, the 2nd output tells how many belong to each image
+        if len(outputs) < 2 or len(outputs[1]) != len(inputs):
+            return one_by_one()
+        return np.split(outputs[0], np.cumsum(outputs[1])[:-1])
+
     def __call__(self, image_list, thr=0.7, batch_size=16):
         res = []
-        imgs = []
-        for i in range(len(image_list)):
-            if not isinstance(image_list[i], np.ndarray):
-                imgs.append(np.array(image_list[i]))
-            else: imgs.append(image_list[i])
-
-        batch_loop_cnt = math.ceil(float(len(imgs)) / batch_size)
+        # images are turned into arrays batch by batch, so that a lazy
+        # `image_list` (PageImageCache) never has more than its window in memory
+        if getattr(image_list, "window", None):
+            batch_size = min(batch_size, image_list.window)
+        batch_loop_cnt = math.ceil(float(len(image_list)) / batch_size)
         for i in range(batch_loop_cnt):
             start_index = i * batch_size
-            end_index = min((i + 1) * batch_size, len(imgs))
-            batch_image_list = imgs[start_index:end_index]
+            end_index = min((i + 1) * batch_size, len(image_list))
+            batch_image_list = [img if isinstance(img, np.ndarray) else np.array(img)
+                                for img in image_list[start_index:end_index]]
             inputs = self.preprocess(batch_image_list)
             print("preprocess")
-            for ins in inputs:
-                bb = self.postprocess(self.ort_sess.run(None, {k:v for k,v in ins.items() if k in self.input_names})[0], ins, thr)
+            for ins, outs in zip(inputs, self.run_batch(inputs)):
+                bb = self.postprocess(outs, ins, thr)
                 res.append(bb)
 
         #seeit.save_results(image_list, res, self.label_list, threshold=thr)
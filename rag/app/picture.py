@@ -19,8 +19,9 @@ from api.db import LLMType
 from api.db.services.llm_service import LLMBundle
 from rag.nlp import tokenize
 from deepdoc.vision import OCR
+from rag.utils.model_registry import LazyModel
 
-ocr = OCR()
+ocr = LazyModel("ocr", OCR)
 
 
 def chunk(filename, binary, tenant_id, lang, callback=None, **kwargs):
@@ -13,48 +13,155 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 #
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
+from urllib.parse import urlparse
 
-from huggingface_hub import snapshot_download
 from zhipuai import ZhipuAI
 import os
 from abc import ABC
 from ollama import Client
 import dashscope
 from openai import OpenAI
-from FlagEmbedding import FlagModel
-import torch
 import numpy as np
 
 from api.utils.file_utils import get_project_base_directory, get_home_cache_dir
 from rag.utils import num_tokens_from_string
+from rag.utils.token_counter import TOKEN_COUNTER, plan_batches
+from rag.utils.model_registry import LazyModel
+from rag.settings import EMBEDDING_CONCURRENCY, EMBEDDING_SERVER
+
+
+def load_flag_model():
+    from FlagEmbedding import FlagModel
+    from huggingface_hub import snapshot_download
+    import torch
+    try:
+        return FlagModel(os.path.join(get_home_cache_dir(), "bge-large-zh-v1.5"),
+            query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
+            use_fp16=torch.cuda.is_available())
+    except Exception as e:
+        model_dir = snapshot_download(repo_id="BAAI/bge-large-zh-v1.5",
+                                      local_dir=os.path.join(get_home_cache_dir(), "bge-large-zh-v1.5"),
+                                      local_dir_use_symlinks=False)
+        return FlagModel(model_dir,
+                         query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
+                         use_fp16=torch.cuda.is_available())
+
+
+# loaded by the first DefaultEmbedding call, or by MODEL_REGISTRY.warmup(["bge-large-zh-v1.5"])
+flag_model = LazyModel("bge-large-zh-v1.5", load_flag_model)
+
+
+class EmbeddingClient(object):
+    """
+    Stands for the FlagModel served by rag/llm/embedding_server.py. Every thread
+    has its own connection, so the concurrent calls of a process reach the
+    server at once and get batched together there.
+    """
+
+    def __init__(self, host, port, authkey="infiniflow-token4kevinhu", timeout=600):
+        self.address = (host, int(port))
+        self.authkey = authkey.encode("utf-8") if isinstance(authkey, str) else authkey
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _conn(self):
+        # connections are neither shared by threads nor inherited by forked processes
+        if getattr(self._local, "pid", None) != os.getpid():
+            from multiprocessing.connection import Client
+            self._local.conn, self._local.pid = Client(self.address, authkey=self.authkey), os.getpid()
+        return self._local.conn
+
+    def _drop(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn, self._local.pid = None, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception as e:
+                pass
 
-
-try:
-    flag_model = FlagModel(os.path.join(get_home_cache_dir(), "bge-large-zh-v1.5"),
-        query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-        use_fp16=torch.cuda.is_available())
-except Exception as e:
-    model_dir = snapshot_download(repo_id="BAAI/bge-large-zh-v1.5",
-                                  local_dir=os.path.join(get_home_cache_dir(), "bge-large-zh-v1.5"),
-                                  local_dir_use_symlinks=False)
-    flag_model = FlagModel(model_dir,
-                           query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
-                           use_fp16=torch.cuda.is_available())
+    def _call(self, name, *args, **kwargs):
+        err = None
+        for i in range(3):
+            try:
+                conn = self._conn()
+                conn.send(pickle.dumps((name, args, kwargs)))
+                if not conn.poll(self.timeout):
+                    raise Exception("Embedding server timeout: no response in {}s".format(self.timeout))
+                r = pickle.loads(conn.recv())
+                break
+            except (EOFError, OSError) as e:
+                # a failed connection may still get the response, which would be
+                # taken for the next call's, so it's never reused
+                self._drop()
+                err = e
+            except BaseException as e:
+                self._drop()
+                raise e
+        else:
+            raise Exception("Embedding server connection lost: {}".format(err))
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+    def encode(self, texts):
+        return self._call("encode", list(texts))
+
+    def encode_queries(self, texts):
+        return self._call("encode_queries", list(texts))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def embedding_client(host, port, authkey="infiniflow-token4kevinhu", timeout=600):
+    """The EmbeddingClient of a server, shared by the models of the process."""
+    key = (host, int(port), authkey, timeout)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = EmbeddingClient(host, port, authkey, timeout)
+        return _clients[key]
 
 
 class Base(ABC):
+    # requests sent at once by fan_out, overridden by EMBEDDING_CONCURRENCY[class name]
+    max_in_flight = 1
+    # padded tokens of a batch of texts, see plan_batches
+    batch_tokens = 8192
+
     def __init__(self, key, model_name):
         pass
 
+    def fan_out(self, fn, items):
+        """[fn(item) for item in items], running at most `max_in_flight` of them at once."""
+        n = min(int(EMBEDDING_CONCURRENCY.get(self.__class__.__name__, self.max_in_flight)), len(items))
+        if n <= 1:
+            return [fn(it) for it in items]
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            return list(pool.map(fn, items))
+
     def encode(self, texts: list, batch_size=32):
         raise NotImplementedError("Please implement encode method!")
 
     def encode_queries(self, text: str):
         raise NotImplementedError("Please implement encode method!")
 
+    def encode_queries_batch(self, texts: list):
+        arr, tks_num = [], 0
+        for v, c in self.fan_out(self.encode_queries, texts):
+            arr.append(v)
+            tks_num += c
+        return arr, tks_num
+
 
 class DefaultEmbedding(Base):
+    batch_tokens = 4096
+
     def __init__(self, *args, **kwargs):
         """
         If you have trouble downloading HuggingFace models, -_^ this might help!!
@@ -67,22 +174,47 @@ class DefaultEmbedding(Base):
         ^_-
 
         """
-        self.model = flag_model
+        # the model of the node's embedding server if there's one, or of this process
+        self.model_name = "bge-large-zh-v1.5"
+        if EMBEDDING_SERVER.get("port"):
+            self.model = embedding_client(EMBEDDING_SERVER.get("host", "127.0.0.1"), EMBEDDING_SERVER["port"],
+                                          EMBEDDING_SERVER.get("authkey", "infiniflow-token4kevinhu"),
+                                          float(EMBEDDING_SERVER.get("timeout", 600)))
+        else:
+            self.model = flag_model
 
     def encode(self, texts: list, batch_size=32):
         texts = [t[:2000] for t in texts]
-        token_count = 0
-        for t in texts:
-            token_count += num_tokens_from_string(t)
-        res = []
-        for i in range(0, len(texts), batch_size):
-            res.extend(self.model.encode(texts[i:i + batch_size]).tolist())
-        return np.array(res), token_count
+        cnts = TOKEN_COUNTER.count_batch(texts)
+        res = None
+        for idx in plan_batches(cnts, self.batch_tokens, batch_size):
+            vts = self.model.encode([texts[i] for i in idx])
+            if res is None:
+                res = np.empty((len(texts), vts.shape[-1]), dtype=vts.dtype)
+            res[idx] = vts
+        return res if res is not None else np.array([]), sum(cnts)
 
     def encode_queries(self, text: str):
         token_count = num_tokens_from_string(text)
         return self.model.encode_queries([text]).tolist()[0], token_count
 
+    def encode_queries_batch(self, texts: list):
+        token_count = sum(TOKEN_COUNTER.count_batch(texts))
+        return self.model.encode_queries(texts).tolist(), token_count
+
+
+class LocalEmbed(DefaultEmbedding):
+    """The model of an embedding server at `base_url`, e.g. localhost:7861, port 7861 by default."""
+
+    def __init__(self, key, model_name, **kwargs):
+        base_url = kwargs["base_url"].strip()
+        if "://" not in base_url:
+            base_url = "tcp://" + base_url
+        url = urlparse(base_url)
+        self.model_name = model_name
+        self.model = embedding_client(url.hostname or "127.0.0.1", url.port or 7861,
+                                      timeout=float(EMBEDDING_SERVER.get("timeout", 600)))
+
 
 class OpenAIEmbed(Base):
     def __init__(self, key, model_name="text-embedding-ada-002",
@@ -103,8 +235,15 @@ class OpenAIEmbed(Base):
                                             model=self.model_name)
         return np.array(res.data[0].embedding), res.usage.total_tokens
 
+    def encode_queries_batch(self, texts: list):
+        res = self.client.embeddings.create(input=texts,
+                                            model=self.model_name)
+        return [np.array(d.embedding) for d in res.data], res.usage.total_tokens
+
 
 class QWenEmbed(Base):
+    max_in_flight = 4
+
     def __init__(self, key, model_name="text_embedding_v2", **kwargs):
         dashscope.api_key = key
         self.model_name = model_name
@@ -114,12 +253,15 @@ class QWenEmbed(Base):
         res = []
         token_count = 0
         texts = [txt[:2048] for txt in texts]
-        for i in range(0, len(texts), batch_size):
-            resp = dashscope.TextEmbedding.call(
+
+        def call(i):
+            return dashscope.TextEmbedding.call(
                 model=self.model_name,
                 input=texts[i:i + batch_size],
                 text_type="document"
             )
+
+        for resp in self.fan_out(call, list(range(0, len(texts), batch_size))):
             embds = [[] for _ in range(len(resp["output"]["embeddings"]))]
             for e in resp["output"]["embeddings"]:
                 embds[e["text_index"]] = e["embedding"]
@@ -138,6 +280,8 @@ class QWenEmbed(Base):
 
 
 class ZhipuEmbed(Base):
+    max_in_flight = 8
+
     def __init__(self, key, model_name="embedding-2", **kwargs):
         self.client = ZhipuAI(api_key=key)
         self.model_name = model_name
@@ -145,9 +289,7 @@ class ZhipuEmbed(Base):
     def encode(self, texts: list, batch_size=32):
         arr = []
         tks_num = 0
-        for txt in texts:
-            res = self.client.embeddings.create(input=txt,
-                                                model=self.model_name)
+        for res in self.fan_out(lambda txt: self.client.embeddings.create(input=txt, model=self.model_name), texts):
             arr.append(res.data[0].embedding)
             tks_num += res.usage.total_tokens
         return np.array(arr), tks_num
@@ -159,6 +301,8 @@ class ZhipuEmbed(Base):
 
 
 class OllamaEmbed(Base):
+    max_in_flight = 4
+
     def __init__(self, key, model_name, **kwargs):
         self.client = Client(host=kwargs["base_url"])
         self.model_name = model_name
@@ -166,9 +310,7 @@ class OllamaEmbed(Base):
     def encode(self, texts: list, batch_size=32):
         arr = []
         tks_num = 0
-        for txt in texts:
-            res = self.client.embeddings(prompt=txt,
-                                         model=self.model_name)
+        for res in self.fan_out(lambda txt: self.client.embeddings(prompt=txt, model=self.model_name), texts):
             arr.append(res["embedding"])
             tks_num += 128
         return np.array(arr), tks_num
@@ -189,6 +331,7 @@ class FastEmbed(Base):
         **kwargs,
     ):
         from fastembed import TextEmbedding
+        self.model_name = model_name
         self._model = TextEmbedding(model_name, cache_dir, threads, **kwargs)
 
     def encode(self, texts: list, batch_size=32):
@@ -226,6 +369,11 @@ class XinferenceEmbed(Base):
                                             model=self.model_name)
         return np.array(res.data[0].embedding), res.usage.total_tokens
 
+    def encode_queries_batch(self, texts: list):
+        res = self.client.embeddings.create(input=texts,
+                                            model=self.model_name)
+        return [np.array(d.embedding) for d in res.data], res.usage.total_tokens
+
 
 class YoudaoEmbed(Base):
     _client = None
@@ -245,9 +393,7 @@ class YoudaoEmbed(Base):
 
     def encode(self, texts: list, batch_size=10):
         res = []
-        token_count = 0
-        for t in texts:
-            token_count += num_tokens_from_string(t)
+        token_count = sum(TOKEN_COUNTER.count_batch(texts))
         for i in range(0, len(texts), batch_size):
             embds = YoudaoEmbed._client.encode(texts[i:i + batch_size])
             res.extend(embds)
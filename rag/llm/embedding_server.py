@@ -0,0 +1,164 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import argparse
+import pickle
+import queue
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Listener
+from threading import Thread
+
+import numpy as np
+
+
+class RPCHandler:
+    def __init__(self):
+        self._functions = {}
+
+    def register_function(self, func):
+        self._functions[func.__name__] = func
+
+    def handle_connection(self, connection):
+        try:
+            while True:
+                # Receive a message
+                func_name, args, kwargs = pickle.loads(connection.recv())
+                # Run the RPC and send a response
+                try:
+                    r = self._functions[func_name](*args, **kwargs)
+                    connection.send(pickle.dumps(r))
+                except Exception as e:
+                    connection.send(pickle.dumps(e))
+        except EOFError:
+            pass
+
+
+def rpc_server(hdlr, address, authkey):
+    # the default backlog of 1 stalls the processes and threads connecting at once
+    sock = Listener(address, authkey=authkey, backlog=128)
+    while True:
+        try:
+            client = sock.accept()
+            t = Thread(target=hdlr.handle_connection, args=(client,))
+            t.daemon = True
+            t.start()
+        except Exception as e:
+            print("【EXCEPTION】:", str(e))
+
+
+class MicroBatcher(object):
+    """
+    Coalesces the concurrent calls of the connections into batches of at most
+    `max_batch` texts. Once a call is queued, more are waited for `max_wait`
+    seconds at most. Every model replica has a thread running the batches.
+    """
+
+    def __init__(self, models, max_batch=64, max_wait=0.01):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        for m in models:
+            t = Thread(target=self._run, args=(m,))
+            t.daemon = True
+            t.start()
+
+    def submit(self, kind, texts):
+        fut = Future()
+        self.queue.put((kind, texts, fut))
+        return fut.result()
+
+    def _collect(self):
+        reqs = [self.queue.get()]
+        n = len(reqs[0][1])
+        deadline = time.time() + self.max_wait
+        while n < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                r = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            reqs.append(r)
+            n += len(r[1])
+        return reqs
+
+    def _run(self, model):
+        while True:
+            reqs = self._collect()
+            # encode and encode_queries embed differently, so they're batched apart
+            for kind in ["encode", "encode_queries"]:
+                group = [r for r in reqs if r[0] == kind]
+                if not group:
+                    continue
+                try:
+                    vecs = getattr(model, kind)([t for _, texts, _ in group for t in texts])
+                except Exception as e:
+                    for _, _, fut in group:
+                        fut.set_exception(e)
+                    continue
+                i = 0
+                for _, texts, fut in group:
+                    fut.set_result(vecs[i: i + len(texts)])
+                    i += len(texts)
+
+
+batcher = None
+
+
+def encode(texts):
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    return batcher.submit("encode", texts)
+
+
+def encode_queries(texts):
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    return batcher.submit("encode_queries", texts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, default="", help="FlagModel path, bge-large-zh-v1.5 if not set")
+    parser.add_argument("--host", default="127.0.0.1", type=str, help="RPC serving host")
+    parser.add_argument("--port", default=7861, type=int, help="RPC serving port")
+    parser.add_argument("--authkey", default="infiniflow-token4kevinhu", type=str)
+    parser.add_argument("--workers", default=1, type=int, help="Model replicas")
+    parser.add_argument("--max_batch", default=64, type=int, help="Texts of a batch")
+    parser.add_argument("--max_wait_ms", default=10, type=int, help="Wait for more calls to batch")
+    args = parser.parse_args()
+
+    from rag.llm.embedding_model import load_flag_model
+
+    def load():
+        if not args.model_name:
+            return load_flag_model()
+        from FlagEmbedding import FlagModel
+        import torch
+        return FlagModel(args.model_name,
+                         query_instruction_for_retrieval="为这个句子生成表示以用于检索相关文章：",
+                         use_fp16=torch.cuda.is_available())
+
+    handler = RPCHandler()
+    handler.register_function(encode)
+    handler.register_function(encode_queries)
+
+    batcher = MicroBatcher([load() for _ in range(args.workers)],
+                           max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000.)
+
+    # Run the server
+    rpc_server(handler, (args.host, args.port), authkey=args.authkey.encode("utf-8"))
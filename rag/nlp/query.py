@@ -5,6 +5,7 @@ import math
 import re
 import logging
 import copy
+import numpy as np
 from elasticsearch_dsl import Q
 
 from rag.nlp import rag_tokenizer, term_weight, synonym
@@ -133,25 +134,46 @@ class EsQueryer:
 
     def hybrid_similarity(self, avec, bvecs, atks, btkss, tkweight=0.3,
                           vtweight=0.7):
+        sim, tksim, vtsim = self.hybrid_similarity_matrix([avec], bvecs, [atks], btkss, tkweight, vtweight)
+        return sim[0], tksim[0], vtsim[0]
+
+    def hybrid_similarity_matrix(self, avecs, bvecs, atkss, btkss, tkweight=0.3,
+                                 vtweight=0.7):
+        """hybrid_similarity of every question (row) against every chunk (column)."""
         from sklearn.metrics.pairwise import cosine_similarity as CosineSimilarity
-        import numpy as np
-        sims = CosineSimilarity([avec], bvecs)
-
-        def toDict(tks):
-            d = {}
-            if isinstance(tks, str):
-                tks = tks.split(" ")
-            for t, c in self.tw.weights(tks):
-                if t not in d:
-                    d[t] = 0
-                d[t] += c
-            return d
-
-        atks = toDict(atks)
-        btkss = [toDict(tks) for tks in btkss]
-        tksim = [self.similarity(atks, btks) for btks in btkss]
-        return np.array(sims[0]) * vtweight + \
-            np.array(tksim) * tkweight, tksim, sims[0]
+        sims = CosineSimilarity(avecs, bvecs)
+        tksim = self.token_similarity_matrix(atkss, btkss)
+        return sims * vtweight + tksim * tkweight, tksim, sims
+
+    def token_similarity(self, atks, btkss):
+        return self.token_similarity_matrix([atks], btkss)[0]
+
+    def token_similarity_matrix(self, atkss, btkss):
+        """
+        similarity() of every question (row) against every chunk (column) at once. A chunk is
+        given by its tokens or by its term weights as a dict (see term_weight.Dealer.load_weights).
+        """
+        qtwts = [self.tw.term_dict(a) for a in atkss]
+        dtwts = [b if isinstance(b, dict) else self.tw.term_dict(b) for b in btkss]
+        vocab = np.array(sorted(set([t for q in qtwts for t in q])), dtype=str)
+        # the questions' weights and the chunks' term indicators over the questions' terms
+        Q = np.zeros((len(qtwts), len(vocab)))
+        for i, q in enumerate(qtwts):
+            if q:
+                Q[i, np.searchsorted(vocab, np.array(list(q.keys()), dtype=str))] = list(q.values())
+        D = np.zeros((len(dtwts), len(vocab)))
+        dlen = np.array([len(d) for d in dtwts], dtype=np.int64)
+        terms = np.array([t for d in dtwts for t in d], dtype=str)
+        if len(vocab) and len(terms):
+            owner = np.repeat(np.arange(len(dtwts)), dlen)
+            pos = np.minimum(np.searchsorted(vocab, terms), len(vocab) - 1)
+            hit = vocab[pos] == terms
+            D[owner[hit], pos[hit]] = 1
+        s = Q @ D.T + 1e-9
+        q = 1e-9 + np.sum(Q, axis=1)
+        qlen = np.array([len(q) for q in qtwts], dtype=np.int64)
+        n = np.maximum(np.maximum(qlen[:, None], dlen[None, :]), 1)
+        return s / q[:, None] / np.maximum(1, np.sqrt(np.log10(n)))
 
     def similarity(self, qtwt, dtwt):
         if isinstance(dtwt, type("")):
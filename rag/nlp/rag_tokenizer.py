@@ -7,11 +7,59 @@ import os
 import re
 import string
 import sys
+import threading
+from collections import OrderedDict
 from hanziconv import HanziConv
 from huggingface_hub import snapshot_download
 from nltk import word_tokenize
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 from api.utils.file_utils import get_project_base_directory
+from rag.utils.model_registry import MODEL_REGISTRY
+
+
+class TokenCache:
+    """
+    Bounded LRU cache with hit/miss statistics, shared by threads. Keys longer
+    than `max_key_len` are neither looked up nor kept: whole chunk contents
+    hardly ever repeat and would fill the memory, unlike queries and terms.
+    """
+
+    def __init__(self, capacity=10000, max_key_len=128):
+        self.capacity = capacity
+        self.max_key_len = max_key_len
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, k):
+        if len(k) > self.max_key_len:
+            return None
+        with self._lock:
+            if k not in self._data:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._data.move_to_end(k)
+            return self._data[k]
+
+    def put(self, k, v):
+        if self.capacity <= 0 or len(k) > self.max_key_len:
+            return
+        with self._lock:
+            self._data[k] = v
+            self._data.move_to_end(k)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self._data), "capacity": self.capacity, "max_key_len": self.max_key_len, "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hits / total if total else 0.}
 
 
 class RagTokenizer:
@@ -41,26 +89,52 @@ class RagTokenizer:
         except Exception as e:
             print("[HUQIE]:Faild to build trie, ", fnm, e, file=sys.stderr)
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, cache_size=10000, species=None):
         self.DEBUG = debug
         self.DENOMINATOR = 1000000
-        self.trie_ = datrie.Trie(string.printable)
+        # memoize tokenize, fine_grained_tokenize and the segmentation of ambiguous spans,
+        # keyed on the normalized input. They're flushed whenever the dictionary changes.
+        self.tks_cache_ = TokenCache(cache_size)
+        self.fine_cache_ = TokenCache(cache_size)
+        self.seg_cache_ = TokenCache(cache_size)
+        # the default dictionary is loaded on first use, through the factory
+        # registered in MODEL_REGISTRY if the tokenizer is shared under a species
+        self.species_ = species
+        self._trie = None
         self.DIR_ = os.path.join(get_project_base_directory(), "rag/res", "huqie")
 
         self.stemmer = PorterStemmer()
         self.lemmatizer = WordNetLemmatizer()
 
         self.SPLIT_CHAR = r"([ ,\.<>/?;'\[\]\\`!@#$%^&*\(\)\{\}\|_+=《》，。？、；‘’：“”【】~！￥%……（）——-]+|[a-z\.-]+|[0-9,\.-]+)"
+
+    @property
+    def trie_(self):
+        if self._trie is None:
+            if self.species_:
+                self._trie = MODEL_REGISTRY.get(self.species_)
+            else:
+                self._trie = self.loadDefaultDict_()
+        return self._trie
+
+    @trie_.setter
+    def trie_(self, trie):
+        if self.species_ and self._trie is not None and trie is not self._trie:
+            MODEL_REGISTRY.release(self.species_)
+        self._trie = trie
+
+    def loadDefaultDict_(self):
         try:
-            self.trie_ = datrie.Trie.load(self.DIR_ + ".txt.trie")
-            return
+            return datrie.Trie.load(self.DIR_ + ".txt.trie")
         except Exception as e:
             print("[HUQIE]:Build default trie", file=sys.stderr)
-            self.trie_ = datrie.Trie(string.printable)
+            self._trie = datrie.Trie(string.printable)
 
         self.loadDict_(self.DIR_ + ".txt")
+        return self._trie
 
     def loadUserDict(self, fnm):
+        self.clear_cache()
         try:
             self.trie_ = datrie.Trie.load(fnm + ".trie")
             return
@@ -69,8 +143,18 @@ class RagTokenizer:
         self.loadDict_(fnm)
 
     def addUserDict(self, fnm):
+        self.clear_cache()
         self.loadDict_(fnm)
 
+    def clear_cache(self):
+        for c in [self.tks_cache_, self.fine_cache_, self.seg_cache_]:
+            c.clear()
+
+    def cache_stats(self):
+        return {"tokenize": self.tks_cache_.stats(),
+                "fine_grained_tokenize": self.fine_cache_.stats(),
+                "segment": self.seg_cache_.stats()}
+
     def _strQ2B(self, ustring):
         """把字符串全角转半角"""
         rstring = ""
@@ -170,6 +254,94 @@ class RagTokenizer:
             res.append((tks, s))
         return sorted(res, key=lambda x: x[1], reverse=True)
 
+    def words_(self, chars, s):
+        """Dictionary words starting at chars[s], as dfs_ tries them: (end, trie value)."""
+        res = []
+        for e in range(s + 1, len(chars) + 1):
+            k = self.key_(chars[s:e])
+            if e > s + 1 and not self.trie_.has_keys_with_prefix(k):
+                break
+            if k in self.trie_:
+                res.append((e, self.trie_[k]))
+        return res
+
+    @staticmethod
+    def path_(node):
+        path = []
+        while node:
+            path.append(node[:3])
+            node = node[3]
+        return path[::-1]
+
+    def better_(self, a, b):
+        # higher weight first, then the order dfs_ would have listed the paths in
+        if a[0] != b[0]:
+            return a[0] > b[0]
+        return [e for _, e, _ in self.path_(a[1])] < [e for _, e, _ in self.path_(b[1])]
+
+    def lattice_(self, chars, topn=2):
+        """
+        Same segmentations as dfs_ + sortTks_, but found by dynamic programming
+        over the word lattice instead of enumerating every path.
+
+        score_ is (B + sum of token weights) / number of tokens, so partial paths
+        are kept per (end, number of trailing single-char tokens, number of tokens),
+        the `topn` best of each. The trailing single chars are what dfs_'s pruning looks at.
+        """
+        N = len(chars)
+        if N == 0:
+            return []
+        # lattice[s][c][n]: [(weight, node)], node is (start, end, trie value, previous node)
+        lattice = [{} for _ in range(N + 1)]
+        lattice[0] = {0: {0: [(0, None)]}}
+        for s in range(N):
+            words = self.words_(chars, s)
+            for c, paths in lattice[s].items():
+                S = s + 1
+                if s + 2 <= N and self.trie_.has_keys_with_prefix(self.key_(chars[s])) \
+                        and not self.trie_.has_keys_with_prefix(self.key_(chars[s:s + 2])):
+                    S = s + 2
+                if c >= 3 and self.trie_.has_keys_with_prefix(self.key_(chars[s - 1:s + 1])):
+                    S = s + 2
+                edges = [(e, v) for e, v in words if e >= S]
+                if not edges:
+                    k = self.key_(chars[s])
+                    edges = [(s + 1, self.trie_[k] if k in self.trie_ else (-12, ''))]
+                for e, v in edges:
+                    w = v[0] + (1 if e - s >= 2 else 0)
+                    cc = min(c + 1, 3) if e == s + 1 else 0
+                    nxt = lattice[e].setdefault(cc, {})
+                    for n, best in paths.items():
+                        kept = nxt.setdefault(n + 1, [])
+                        for W, node in best:
+                            cand = (W + w, (s, e, v, node))
+                            i = len(kept)
+                            while i > 0 and self.better_(cand, kept[i - 1]):
+                                i -= 1
+                            if i < topn:
+                                kept.insert(i, cand)
+                                del kept[topn:]
+            lattice[s] = None
+
+        res = []
+        for paths in lattice[N].values():
+            for best in paths.values():
+                for _, node in best:
+                    path = self.path_(node)
+                    tks, sc = self.score_([(chars[s:e], v) for s, e, v in path])
+                    res.append((tks, sc, [e for _, e, _ in path]))
+        res = sorted(res, key=lambda x: (-x[1], x[2]))[:topn]
+        return [(tks, sc) for tks, sc, _ in res]
+
+    def bestSegs_(self, chars):
+        """The best and second best (tokens, score) segmentations of an ambiguous span."""
+        res = self.seg_cache_.get(chars)
+        if res is not None:
+            return res
+        res = self.lattice_(chars, 2)
+        self.seg_cache_.put(chars, res)
+        return res
+
     def merge_(self, tks):
         patts = [
             (r"[ ]+", " "),
@@ -244,6 +416,13 @@ class RagTokenizer:
     def tokenize(self, line):
         line = self._strQ2B(line).lower()
         line = self._tradi2simp(line)
+        res = self.tks_cache_.get(line)
+        if res is None:
+            res = self.tokenize_(line)
+            self.tks_cache_.put(line, res)
+        return res
+
+    def tokenize_(self, line):
         zh_num = len([1 for c in line if is_chinese(c)])
         if zh_num < len(line) * 0.2:
             return " ".join([self.stemmer.stem(self.lemmatizer.lemmatize(t)) for t in word_tokenize(line)])
@@ -287,9 +466,7 @@ class RagTokenizer:
                 while e < len(tks) and e - s < 5 and diff[e] == 1:
                     e += 1
 
-                tkslist = []
-                self.dfs_("".join(tks[s:e + 1]), 0, [], tkslist)
-                res.append(" ".join(self.sortTks_(tkslist)[0][0]))
+                res.append(" ".join(self.bestSegs_("".join(tks[s:e + 1]))[0][0]))
 
                 i = e + 1
 
@@ -299,6 +476,13 @@ class RagTokenizer:
         return self.merge_(res)
 
     def fine_grained_tokenize(self, tks):
+        res = self.fine_cache_.get(tks)
+        if res is None:
+            res = self.fine_grained_tokenize_(tks)
+            self.fine_cache_.put(tks, res)
+        return res
+
+    def fine_grained_tokenize_(self, tks):
         tks = tks.split(" ")
         zh_num = len([1 for c in tks if c and is_chinese(c[0])])
         if zh_num < len(tks) * 0.2:
@@ -312,15 +496,14 @@ class RagTokenizer:
             if len(tk) < 3 or re.match(r"[0-9,\.-]+$", tk):
                 res.append(tk)
                 continue
-            tkslist = []
             if len(tk) > 10:
-                tkslist.append(tk)
-            else:
-                self.dfs_(tk, 0, [], tkslist)
-            if len(tkslist) < 2:
                 res.append(tk)
                 continue
-            stk = self.sortTks_(tkslist)[1][0]
+            segs = self.bestSegs_(tk)
+            if len(segs) < 2:
+                res.append(tk)
+                continue
+            stk = segs[1][0]
             if len(stk) == len(tk):
                 stk = tk
             else:
@@ -371,7 +554,9 @@ def naiveQie(txt):
     return tks
 
 
-tokenizer = RagTokenizer()
+tokenizer = RagTokenizer(species="huqie")
+# so that a process can warm it up by species, see WARMUP in rag/settings.py
+MODEL_REGISTRY.register("huqie", tokenizer.loadDefaultDict_)
 tokenize = tokenizer.tokenize
 fine_grained_tokenize = tokenizer.fine_grained_tokenize
 tag = tokenizer.tag
@@ -380,6 +565,7 @@ loadUserDict = tokenizer.loadUserDict
 addUserDict = tokenizer.addUserDict
 tradi2simp = tokenizer._tradi2simp
 strQ2B = tokenizer._strQ2B
+cache_stats = tokenizer.cache_stats
 
 if __name__ == '__main__':
     tknzr = RagTokenizer(debug=True)
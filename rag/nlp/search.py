@@ -9,6 +9,7 @@ from dataclasses import dataclass
 
 from rag.settings import es_logger
 from rag.utils import rmSpace
+from rag.utils.retrieval_cache import RETRIEVAL_CACHE
 from rag.nlp import rag_tokenizer, query
 import numpy as np
 
@@ -38,9 +39,12 @@ class Dealer:
         aggregation: Union[List, Dict, None] = None
         keywords: Optional[List[str]] = None
         group_docs: List[List] = None
+        # float32 vectors of the candidates, in the order of ids, if it's a vector search
+        vectors: Optional[np.ndarray] = None
 
-    def _vector(self, txt, emb_mdl, sim=0.8, topk=10):
-        qv, c = emb_mdl.encode_queries(txt)
+    def _vector(self, txt, emb_mdl, sim=0.8, topk=10, qv=None):
+        if qv is None:
+            qv, c = emb_mdl.encode_queries(txt)
         return {
             "field": "q_%d_vec" % len(qv),
             "k": topk,
@@ -49,7 +53,8 @@ class Dealer:
             "query_vector": [float(v) for v in qv]
         }
 
-    def search(self, req, idxnm, emb_mdl=None):
+    def _query(self, req, emb_mdl=None, qv=None):
+        """The ES query of a search request, its _source and keywords."""
         qst = req.get("question", "")
         bqry, keywords = self.qryr.question(qst)
         if req.get("kb_ids"):
@@ -70,7 +75,8 @@ class Dealer:
         topk = int(req.get("topk", 1024))
         src = req.get("fields", ["docnm_kwd", "content_ltks", "kb_id", "img_id", "title_tks", "important_kwd",
                                  "image_id", "doc_id", "q_512_vec", "q_768_vec", "position_int",
-                                 "q_1024_vec", "q_1536_vec", "available_int", "content_with_weight"])
+                                 "q_1024_vec", "q_1536_vec", "available_int", "content_with_weight",
+                                 "term_with_weight"])
 
         s = s.query(bqry)[pg * ps:(pg + 1) * ps]
         s = s.highlight("content_ltks")
@@ -102,29 +108,77 @@ class Dealer:
                 boundary_chars=",./;:\\!()，。？：！……（）——、"
             )
         s = s.to_dict()
-        q_vec = []
         if req.get("vector"):
-            assert emb_mdl, "No embedding model selected"
+            assert emb_mdl or qv is not None, "No embedding model selected"
             s["knn"] = self._vector(
                 qst, emb_mdl, req.get(
-                    "similarity", 0.1), topk)
+                    "similarity", 0.1), topk, qv)
             s["knn"]["filter"] = bqry.to_dict()
             if "highlight" in s:
                 del s["highlight"]
-            q_vec = s["knn"]["query_vector"]
+            if "fields" not in req:
+                # only the vectors comparable with the question's
+                src = [f for f in src if not re.match(r"q_[0-9]+_vec$", f)] + [s["knn"]["field"]]
+        return s, src, keywords
+
+    def _relaxed(self, req, s):
+        """The query to fall back on if a vector search `s` finds nothing."""
+        if "knn" not in s:
+            return
+        s = deepcopy(s)
+        bqry, _ = self.qryr.question(req.get("question", ""), min_match="10%")
+        if req.get("kb_ids"):
+            bqry.filter.append(Q("terms", kb_id=req["kb_ids"]))
+        s["query"] = bqry.to_dict()
+        s["knn"]["filter"] = bqry.to_dict()
+        s["knn"]["similarity"] = 0.17
+        return s
+
+    def search(self, req, idxnm, emb_mdl=None):
+        s, src, keywords = self._query(req, emb_mdl)
         es_logger.info("【Q】: {}".format(json.dumps(s)))
         res = self.es.search(deepcopy(s), idxnm=idxnm, timeout="600s", src=src)
         es_logger.info("TOTAL: {}".format(self.es.getTotal(res)))
         if self.es.getTotal(res) == 0 and "knn" in s:
-            bqry, _ = self.qryr.question(qst, min_match="10%")
-            if req.get("kb_ids"):
-                bqry.filter.append(Q("terms", kb_id=req["kb_ids"]))
-            s["query"] = bqry.to_dict()
-            s["knn"]["filter"] = bqry.to_dict()
-            s["knn"]["similarity"] = 0.17
-            res = self.es.search(s, idxnm=idxnm, timeout="600s", src=src)
-            es_logger.info("【Q】: {}".format(json.dumps(s)))
-
+            fallback = self._relaxed(req, s)
+            res = self.es.search(fallback, idxnm=idxnm, timeout="600s", src=src)
+            es_logger.info("【Q】: {}".format(json.dumps(fallback)))
+        return self._result(res, src, keywords, s["knn"]["query_vector"] if "knn" in s else [])
+
+    def msearch(self, reqs, idxnm, emb_mdl=None):
+        """
+        search() of several requests in one ES round trip, with the relaxed fallbacks
+        of the vector searches sent along. The questions are embedded in one batch.
+        """
+        qvs = [None] * len(reqs)
+        vec = [i for i, req in enumerate(reqs) if req.get("vector")]
+        if vec:
+            assert emb_mdl, "No embedding model selected"
+            vs, _ = emb_mdl.encode_queries_batch([reqs[i].get("question", "") for i in vec])
+            for i, v in zip(vec, vs):
+                qvs[i] = v
+        qs, bodies = [], []
+        for req, qv in zip(reqs, qvs):
+            s, src, keywords = self._query(req, emb_mdl, qv)
+            fallback = self._relaxed(req, s)
+            qs.append((s, fallback, src, keywords))
+            bodies.append((s, src))
+            if fallback:
+                bodies.append((fallback, src))
+        es_logger.info("【Q】: {}".format(json.dumps([b for b, _ in bodies])))
+        ress = self.es.msearch(bodies, idxnm=idxnm, timeout="600s")
+        results, j = [], 0
+        for s, fallback, src, keywords in qs:
+            res = ress[j]
+            j += 1
+            if fallback:
+                if self.es.getTotal(res) == 0:
+                    res = ress[j]
+                j += 1
+            results.append(self._result(res, src, keywords, s["knn"]["query_vector"] if "knn" in s else []))
+        return results
+
+    def _result(self, res, src, keywords, q_vec):
         kwds = set([])
         for k in keywords:
             kwds.add(k)
@@ -136,15 +190,18 @@ class Dealer:
                 kwds.add(kk)
 
         aggs = self.getAggregation(res, "docnm_kwd")
+        ids = self.es.getDocIds(res)
+        field = self.getFields(res, src)
 
         return self.SearchResult(
             total=self.es.getTotal(res),
-            ids=self.es.getDocIds(res),
+            ids=ids,
             query_vector=q_vec,
             aggregation=aggs,
             highlight=self.getHighlight(res),
-            field=self.getFields(res, src),
-            keywords=list(kwds)
+            field=field,
+            keywords=list(kwds),
+            vectors=self.getVectors(ids, field, len(q_vec)) if q_vec else None
         )
 
     def getAggregation(self, res, g):
@@ -182,6 +239,9 @@ class Dealer:
         for d in self.es.getSource(sres):
             m = {n: d.get(n) for n in flds if d.get(n) is not None}
             for n, v in m.items():
+                if re.match(r"q_[0-9]+_vec$", n):
+                    m[n] = np.array(v, dtype=np.float32)
+                    continue
                 if isinstance(v, type([])):
                     m[n] = "\t".join([str(vv) if not isinstance(
                         vv, list) else "\t".join([str(vvv) for vvv in vv]) for vv in v])
@@ -195,6 +255,18 @@ class Dealer:
                 res[d["id"]] = m
         return res
 
+    @staticmethod
+    def getVectors(ids, field, dim):
+        """The q_<dim>_vec of the chunks as a float32 matrix, zeros for the missing ones."""
+        fld = "q_%d_vec" % dim
+        mtx = np.zeros((len(ids), dim), dtype=np.float32)
+        for i, id in enumerate(ids):
+            v = field.get(id, {}).get(fld)
+            if v is None:
+                continue
+            mtx[i] = Dealer.trans2floats(v) if isinstance(v, str) else v
+        return mtx
+
     @staticmethod
     def trans2floats(txt):
         return [float(t) for t in txt.split("\t")]
@@ -246,22 +318,22 @@ class Dealer:
         chunks_tks = [rag_tokenizer.tokenize(self.qryr.rmWWW(ck)).split(" ")
                       for ck in chunks]
         cites = {}
-        thr = 0.63
-        while thr>0.3 and len(cites.keys()) == 0 and pieces_ and chunks_tks:
-            for i, a in enumerate(pieces_):
-                sim, tksim, vtsim = self.qryr.hybrid_similarity(ans_v[i],
-                                                                chunk_v,
-                                                                rag_tokenizer.tokenize(
-                                                                    self.qryr.rmWWW(pieces_[i])).split(" "),
-                                                                chunks_tks,
-                                                                tkweight, vtweight)
-                mx = np.max(sim) * 0.99
-                es_logger.info("{} SIM: {}".format(pieces_[i], mx))
-                if mx < thr:
-                    continue
-                cites[idx[i]] = list(
-                    set([str(ii) for ii in range(len(chunk_v)) if sim[ii] > mx]))[:4]
-            thr *= 0.8
+        if chunks_tks:
+            # pieces x chunks, computed once for all the thresholds
+            sim, tksim, vtsim = self.qryr.hybrid_similarity_matrix(ans_v,
+                                                                   chunk_v,
+                                                                   [rag_tokenizer.tokenize(
+                                                                       self.qryr.rmWWW(a)).split(" ") for a in pieces_],
+                                                                   chunks_tks,
+                                                                   tkweight, vtweight)
+            mx = np.max(sim, axis=1) * 0.99
+            es_logger.info("{} SIM: {}".format(pieces_, mx))
+            thr = 0.63
+            while thr > 0.3 and len(cites.keys()) == 0:
+                for i in np.where(mx >= thr)[0]:
+                    cites[idx[i]] = list(
+                        set([str(ii) for ii in np.where(sim[i] > mx[i])[0]]))[:4]
+                thr *= 0.8
 
         res = ""
         seted = set([])
@@ -284,17 +356,24 @@ class Dealer:
     def rerank(self, sres, query, tkweight=0.3,
                vtweight=0.7, cfield="content_ltks"):
         _, keywords = self.qryr.question(query)
-        ins_embd = [
-            Dealer.trans2floats(
-                sres.field[i].get("q_%d_vec" % len(sres.query_vector), "\t".join(["0"] * len(sres.query_vector)))) for i in sres.ids]
-        if not ins_embd:
+        if not sres.ids:
             return [], [], []
+        ins_embd = sres.vectors
+        if ins_embd is None:
+            ins_embd = self.getVectors(sres.ids, sres.field, len(sres.query_vector))
 
         for i in sres.ids:
             if isinstance(sres.field[i].get("important_kwd", []), str):
                 sres.field[i]["important_kwd"] = [sres.field[i]["important_kwd"]]
         ins_tw = []
         for i in sres.ids:
+            tw = None
+            if cfield == "content_ltks" and sres.field[i].get("term_with_weight"):
+                # chunks indexed before the weights were JSON are weighted from their tokens
+                tw = self.qryr.tw.load_weights(sres.field[i]["term_with_weight"])
+            if tw is not None:
+                ins_tw.append(tw)
+                continue
             content_ltks = sres.field[i][cfield].split(" ")
             title_tks = [t for t in sres.field[i].get("title_tks", "").split(" ") if t]
             important_kwd = sres.field[i].get("important_kwd", [])
@@ -313,25 +392,82 @@ class Dealer:
                                            rag_tokenizer.tokenize(ans).split(" "),
                                            rag_tokenizer.tokenize(inst).split(" "))
 
-    def retrieval(self, question, embd_mdl, tenant_id, kb_ids, page, page_size, similarity_threshold=0.2,
-                  vector_similarity_weight=0.3, top=1024, doc_ids=None, aggs=True):
-        ranks = {"total": 0, "chunks": [], "doc_aggs": {}}
-        if not question:
-            return ranks
-        req = {"kb_ids": kb_ids, "doc_ids": doc_ids, "size": page_size,
-               "question": question, "vector": True, "topk": top,
-               "similarity": similarity_threshold}
+    @staticmethod
+    def _retrieval_req(question, kb_ids, doc_ids, page_size, similarity_threshold, top):
+        return {"kb_ids": kb_ids, "doc_ids": doc_ids, "size": page_size,
+                "question": question, "vector": True, "topk": top,
+                "similarity": similarity_threshold}
+
+    @staticmethod
+    def _cache_key(question, embd_mdl, tenant_id, kb_ids, page_size, similarity_threshold,
+                   vector_similarity_weight, top, doc_ids):
+        return RETRIEVAL_CACHE.key(kb_ids, tenant_id, question, getattr(embd_mdl, "llm_name", None),
+                                   doc_ids, page_size, similarity_threshold, vector_similarity_weight, top)
+
+    def rank(self, question, embd_mdl, tenant_id, kb_ids, page_size, similarity_threshold=0.2,
+             vector_similarity_weight=0.3, top=1024, doc_ids=None):
+        """The reranked candidates above similarity_threshold, the best first."""
+        req = self._retrieval_req(question, kb_ids, doc_ids, page_size, similarity_threshold, top)
         sres = self.search(req, index_name(tenant_id), embd_mdl)
+        return self._ranking(sres, question, similarity_threshold, vector_similarity_weight)
 
+    def _ranking(self, sres, question, similarity_threshold, vector_similarity_weight):
         sim, tsim, vsim = self.rerank(
             sres, question, 1 - vector_similarity_weight, vector_similarity_weight)
-        idx = np.argsort(sim * -1)
-
-        dim = len(sres.query_vector)
-        start_idx = (page - 1) * page_size
-        for i in idx:
+        idx = []
+        for i in np.argsort(sim * -1):
             if sim[i] < similarity_threshold:
                 break
+            idx.append(i)
+        vec = "q_%d_vec" % len(sres.query_vector)
+        return {"ids": [sres.ids[i] for i in idx],
+                "sim": [sim[i] for i in idx],
+                "tsim": [tsim[i] for i in idx],
+                "vsim": [vsim[i] for i in idx],
+                "vectors": sres.vectors[idx] if idx else sres.vectors[:0],
+                "field": {sres.ids[i]: {k: v for k, v in sres.field[sres.ids[i]].items() if k != vec}
+                          for i in idx}}
+
+    def retrieval(self, question, embd_mdl, tenant_id, kb_ids, page, page_size, similarity_threshold=0.2,
+                  vector_similarity_weight=0.3, top=1024, doc_ids=None, aggs=True):
+        if not question:
+            return {"total": 0, "chunks": [], "doc_aggs": {}}
+        # The ranking doesn't depend on the page, so the next pages are served from the cache.
+        key = self._cache_key(question, embd_mdl, tenant_id, kb_ids, page_size, similarity_threshold,
+                              vector_similarity_weight, top, doc_ids)
+        rk = RETRIEVAL_CACHE.get(key) if key else None
+        if rk is None:
+            rk = self.rank(question, embd_mdl, tenant_id, kb_ids, page_size, similarity_threshold,
+                           vector_similarity_weight, top, doc_ids)
+            if key:
+                RETRIEVAL_CACHE.put(key, rk)
+        return self._paginate(rk, page, page_size, aggs)
+
+    def retrieval_batch(self, questions, embd_mdl, tenant_id, kb_ids, page, page_size, similarity_threshold=0.2,
+                        vector_similarity_weight=0.3, top=1024, doc_ids=None, aggs=True):
+        """
+        retrieval() of every question, in the same order. The questions which aren't
+        cached are embedded in one batch and searched in one ES round trip.
+        """
+        keys = [self._cache_key(q, embd_mdl, tenant_id, kb_ids, page_size, similarity_threshold,
+                                vector_similarity_weight, top, doc_ids) if q else None for q in questions]
+        rks = [RETRIEVAL_CACHE.get(k) if k else None for k in keys]
+        todo = [i for i, q in enumerate(questions) if q and rks[i] is None]
+        if todo:
+            reqs = [self._retrieval_req(questions[i], kb_ids, doc_ids, page_size, similarity_threshold, top)
+                    for i in todo]
+            for i, sres in zip(todo, self.msearch(reqs, index_name(tenant_id), embd_mdl)):
+                rks[i] = self._ranking(sres, questions[i], similarity_threshold, vector_similarity_weight)
+                if keys[i]:
+                    RETRIEVAL_CACHE.put(keys[i], rks[i])
+        return [self._paginate(rk, page, page_size, aggs) if q else {"total": 0, "chunks": [], "doc_aggs": {}}
+                for q, rk in zip(questions, rks)]
+
+    def _paginate(self, rk, page, page_size, aggs=True):
+        ranks = {"total": 0, "chunks": [], "doc_aggs": {}}
+        sim, tsim, vsim = rk["sim"], rk["tsim"], rk["vsim"]
+        start_idx = (page - 1) * page_size
+        for i in range(len(rk["ids"])):
             ranks["total"] += 1
             start_idx -= 1
             if start_idx >= 0:
@@ -340,23 +476,24 @@ class Dealer:
                 if aggs:
                     continue
                 break
-            id = sres.ids[i]
-            dnm = sres.field[id]["docnm_kwd"]
-            did = sres.field[id]["doc_id"]
+            id = rk["ids"][i]
+            fld = rk["field"][id]
+            dnm = fld["docnm_kwd"]
+            did = fld["doc_id"]
             d = {
                 "chunk_id": id,
-                "content_ltks": sres.field[id]["content_ltks"],
-                "content_with_weight": sres.field[id]["content_with_weight"],
-                "doc_id": sres.field[id]["doc_id"],
+                "content_ltks": fld["content_ltks"],
+                "content_with_weight": fld["content_with_weight"],
+                "doc_id": fld["doc_id"],
                 "docnm_kwd": dnm,
-                "kb_id": sres.field[id]["kb_id"],
-                "important_kwd": sres.field[id].get("important_kwd", []),
-                "img_id": sres.field[id].get("img_id", ""),
+                "kb_id": fld["kb_id"],
+                "important_kwd": fld.get("important_kwd", []),
+                "img_id": fld.get("img_id", ""),
                 "similarity": sim[i],
                 "vector_similarity": vsim[i],
                 "term_similarity": tsim[i],
-                "vector": self.trans2floats(sres.field[id].get("q_%d_vec" % dim, "\t".join(["0"] * dim))),
-                "positions": sres.field[id].get("position_int", "").split("\t")
+                "vector": rk["vectors"][i].tolist(),
+                "positions": fld.get("position_int", "").split("\t")
             }
             if len(d["positions"]) % 5 == 0:
                 poss = []
@@ -5,6 +5,7 @@ import re
 import os
 import numpy as np
 from rag.nlp import rag_tokenizer
+from rag.utils import rmSpace
 from api.utils.file_utils import get_project_base_directory
 
 
@@ -218,3 +219,36 @@ class Dealer:
 
         S = np.sum([s for _, s in tw])
         return [(t, s / S) for t, s in tw]
+
+    def term_dict(self, tks):
+        d = {}
+        if isinstance(tks, str):
+            tks = tks.split(" ")
+        for t, c in self.weights(tks):
+            if t not in d:
+                d[t] = 0
+            d[t] += c
+        return d
+
+    def chunk_weights(self, content_ltks, title_tks="", important_kwd=[]):
+        """
+        Term weights of a chunk as rerank looks at it, as a JSON object, since
+        merged terms may hold spaces. They're computed at indexing time and
+        stored in `term_with_weight`.
+        """
+        # the fields as search.Dealer.getFields hands them to rerank
+        tks = rmSpace(content_ltks).split(" ") + [t for t in rmSpace(title_tks).split(" ") if t]
+        if isinstance(important_kwd, str):
+            important_kwd = [important_kwd]
+        tks.append("\t".join(important_kwd))
+        return json.dumps(self.term_dict(tks), ensure_ascii=False)
+
+    @staticmethod
+    def load_weights(txt):
+        """The term weights packed by chunk_weights, None if `txt` isn't packed that way."""
+        if not txt.startswith("{"):
+            return
+        try:
+            return json.loads(txt)
+        except Exception as e:
+            return
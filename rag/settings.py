@@ -31,6 +31,32 @@ except Exception as e:
     REDIS = {}
     pass
 DOC_MAXIMUM_SIZE = 128 * 1024 * 1024
+# backend: db(polling MySQL, default) | redis | memory
+TASK_QUEUE = get_base_config("task_queue", {}) or {}
+# pipeline: overlap chunking, embedding and indexing of consecutive tasks
+# with chunk_workers / embedding_workers / index_workers concurrency.
+TASK_EXECUTOR = get_base_config("task_executor", {}) or {}
+# parallel_ocr: rasterize and OCR PDF pages in a pool of ocr_workers(default: #cores) processes
+# page_window: keep at most this number of page images in memory, the others are
+# spilled on disk or rendered again if page_spill is "render"
+# intra_op_num_threads / inter_op_num_threads: per session threads of the layout and table models
+DEEPDOC = get_base_config("deepdoc", {}) or {}
+# query_size / query_ttl: in-process LRU of question vectors, query_redis: share them through Redis as well
+# store: keep chunk vectors by (model, md5 of the text) in the SQLite file store_path, store_rows at most
+EMBEDDING_CACHE = get_base_config("embedding_cache", {}) or {}
+# max requests in flight per embedding class, e.g. {ZhipuEmbed: 8, OllamaEmbed: 4, QWenEmbed: 4}
+EMBEDDING_CONCURRENCY = get_base_config("embedding_concurrency", {}) or {}
+# host / port / authkey / timeout(seconds, default: 600) of rag/llm/embedding_server.py;
+# if set, DefaultEmbedding uses it instead of its own model
+EMBEDDING_SERVER = get_base_config("embedding_server", {}) or {}
+# size / ttl: ranked retrieval results kept per process, checked against the knowledgebase versions in Redis
+RETRIEVAL_CACHE = get_base_config("retrieval_cache", {}) or {}
+# enabled: cache the answers of all dialogs (a dialog opts in or out by prompt_config.answer_cache)
+# threshold: least cosine similarity of the questions, size / ttl: answers kept per dialog, dialogs: dialogs kept
+ANSWER_CACHE = get_base_config("answer_cache", {}) or {}
+# api / executor / broker: model species (see rag/utils/model_registry.py) each process loads before serving,
+# e.g. elasticsearch, huqie, ocr, layout, tsr, updown_concat_xgb, bge-large-zh-v1.5; the others load on first use
+WARMUP = get_base_config("warmup", {}) or {}
 
 # Logger
 LoggerFactory.set_directory(
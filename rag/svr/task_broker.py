@@ -24,7 +24,7 @@ from api.db.services.file2document_service import File2DocumentService
 from api.db.services.task_service import TaskService
 from deepdoc.parser import PdfParser
 from deepdoc.parser.excel_parser import RAGFlowExcelParser
-from rag.settings import cron_logger
+from rag.settings import cron_logger, WARMUP
 from rag.utils.minio_conn import MINIO
 from rag.utils import findMaxTm
 import pandas as pd
@@ -34,8 +34,10 @@ from api.settings import database_logger
 from api.utils import get_format_time, get_uuid
 from api.utils.file_utils import get_project_base_directory
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.task_queue import queue_enabled, get_task_queue
 from api.db.db_models import init_database_tables as init_web_db
 from api.db.init_data import init_web_data
+from rag.utils.model_registry import MODEL_REGISTRY, startup_report
 
 
 def collect(tm):
@@ -125,6 +127,11 @@ def dispatch():
                 tsks.append(new_task())
 
             bulk_insert_into_db(Task, tsks, True)
+            if queue_enabled():
+                queue = get_task_queue()
+                for t in tsks:
+                    queue.produce({"id": t["id"], "doc_id": t["doc_id"],
+                                   "from_page": t.get("from_page", 0), "to_page": t.get("to_page", -1)})
             set_dispatching(r["id"])
         except Exception as e:
             cron_logger.exception(e)
@@ -182,6 +189,8 @@ if __name__ == "__main__":
     # init db
     init_web_db()
     init_web_data()
+    MODEL_REGISTRY.warmup(WARMUP.get("broker", []))
+    startup_report("Task broker")
 
     while True:
         dispatch()
@@ -29,8 +29,11 @@ from api.db.services.file2document_service import File2DocumentService
 from rag.utils.minio_conn import MINIO
 from api.db.db_models import close_connection
 from rag.settings import database_logger
-from rag.settings import cron_logger, DOC_MAXIMUM_SIZE
+from rag.settings import cron_logger, DOC_MAXIMUM_SIZE, TASK_EXECUTOR, WARMUP, DEEPDOC
 from multiprocessing import Pool
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 from elasticsearch_dsl import Q
 from multiprocessing.context import TimeoutError
@@ -39,7 +42,7 @@ from rag.utils.es_conn import ELASTICSEARCH
 from timeit import default_timer as timer
 from rag.utils import rmSpace, findMaxTm
 
-from rag.nlp import search
+from rag.nlp import search, term_weight
 from io import BytesIO
 import pandas as pd
 
@@ -50,9 +53,16 @@ from api.db.services.document_service import DocumentService
 from api.db.services.llm_service import LLMBundle
 from api.utils.file_utils import get_project_base_directory
 from rag.utils.redis_conn import REDIS_CONN
+from rag.utils.retrieval_cache import bump_kb_version
+from rag.utils.embedding_store import EMBEDDING_STORE
+from rag.utils.token_counter import TOKEN_COUNTER, plan_batches
+from rag.utils.task_queue import queue_enabled, get_task_queue
+from rag.utils.model_registry import MODEL_REGISTRY, startup_report
 
 BATCH_SIZE = 64
 
+TERM_WEIGHT = term_weight.Dealer()
+
 FACTORY = {
     "general": naive,
     ParserType.NAIVE.value: naive,
@@ -164,6 +174,8 @@ def build(row):
     for ck in cks:
         d = copy.deepcopy(doc)
         d.update(ck)
+        d["term_with_weight"] = TERM_WEIGHT.chunk_weights(d.get("content_ltks", ""), d.get("title_tks", ""),
+                                                          d.get("important_kwd", []))
         md5 = hashlib.md5()
         md5.update((ck["content_with_weight"] +
                    str(d["doc_id"])).encode("utf-8"))
@@ -199,33 +211,42 @@ def init_kb(row):
         open(os.path.join(get_project_base_directory(), "conf", "mapping.json"), "r")))
 
 
+def encode_unique(mdl, texts, batch_size, callback, prog, span):
+    """
+    Encodes every distinct text once and broadcasts the vectors back to `texts`,
+    so only the tokens of the distinct ones are billed.
+    """
+    uniq, idx = {}, []
+    for t in texts:
+        idx.append(uniq.setdefault(t, len(uniq)))
+    uniq = list(uniq.keys())
+    if not uniq:
+        return np.array([]), 0
+    # length-sorted batches under the model's token budget, written into place
+    budget = getattr(getattr(mdl, "mdl", mdl), "batch_tokens", 8192)
+    vects, tk_count, done = None, 0, 0
+    for b in plan_batches(TOKEN_COUNTER.count_batch(uniq), budget, batch_size):
+        vts, c = EMBEDDING_STORE.encode(mdl, [uniq[i] for i in b])
+        if vects is None:
+            vects = np.empty((len(uniq), len(vts[0])), dtype=np.float64)
+        vects[b] = vts
+        tk_count += c
+        done += len(b)
+        callback(prog=prog + span * done / len(uniq), msg="")
+    return vects[idx], tk_count
+
+
 def embedding(docs, mdl, parser_config={}, callback=None):
     batch_size = 32
     tts, cnts = [rmSpace(d["title_tks"]) for d in docs if d.get("title_tks")], [
         re.sub(r"</?(table|td|caption|tr|th)( [^<>]{0,12})?>", " ", d["content_with_weight"]) for d in docs]
     tk_count = 0
     if len(tts) == len(cnts):
-        tts_ = np.array([])
-        for i in range(0, len(tts), batch_size):
-            vts, c = mdl.encode(tts[i: i + batch_size])
-            if len(tts_) == 0:
-                tts_ = vts
-            else:
-                tts_ = np.concatenate((tts_, vts), axis=0)
-            tk_count += c
-            callback(prog=0.6 + 0.1 * (i + 1) / len(tts), msg="")
-        tts = tts_
-
-    cnts_ = np.array([])
-    for i in range(0, len(cnts), batch_size):
-        vts, c = mdl.encode(cnts[i: i + batch_size])
-        if len(cnts_) == 0:
-            cnts_ = vts
-        else:
-            cnts_ = np.concatenate((cnts_, vts), axis=0)
+        tts, c = encode_unique(mdl, tts, batch_size, callback, 0.6, 0.1)
         tk_count += c
-        callback(prog=0.7 + 0.2 * (i + 1) / len(cnts), msg="")
-    cnts = cnts_
+
+    cnts, c = encode_unique(mdl, cnts, batch_size, callback, 0.7, 0.2)
+    tk_count += c
 
     title_w = float(parser_config.get("filename_embd_weight", 0.1))
     vects = (title_w * tts + (1 - title_w) *
@@ -238,6 +259,188 @@ def embedding(docs, mdl, parser_config={}, callback=None):
     return tk_count
 
 
+def get_embd_mdl(r):
+    try:
+        return LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
+    except Exception as e:
+        traceback.print_stack(e)
+        set_progress(r["id"], r["from_page"], r["to_page"], prog=-1, msg=str(e))
+
+
+def do_embedding(r, cks, embd_mdl):
+    callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
+    # TODO: exception handler
+    ## set_progress(r["did"], -1, "ERROR: ")
+    callback(
+        msg="Finished slicing files(%d). Start to embedding the content." %
+        len(cks))
+    st = timer()
+    try:
+        tk_count = embedding(cks, embd_mdl, r["parser_config"], callback)
+    except Exception as e:
+        callback(-1, "Embedding error:{}".format(str(e)))
+        cron_logger.error(str(e))
+        tk_count = 0
+    cron_logger.info("Embedding elapsed({}): {}".format(r["name"], timer()-st))
+    callback(msg="Finished embedding({})! Start to build index!".format(timer()-st))
+    return tk_count
+
+
+def do_index(r, cks, tk_count):
+    callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
+    init_kb(r)
+    chunk_count = len(set([c["_id"] for c in cks]))
+    st = timer()
+    es_r = ELASTICSEARCH.bulk(cks, search.index_name(r["tenant_id"]))
+    cron_logger.info("Indexing elapsed({}): {}".format(r["name"], timer()-st))
+    if es_r:
+        callback(-1, "Index failure!")
+        ELASTICSEARCH.deleteByQuery(
+            Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+        bump_kb_version(r["kb_id"])
+        cron_logger.error(str(es_r))
+        return True
+    if TaskService.do_cancel(r["id"]):
+        ELASTICSEARCH.deleteByQuery(
+            Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
+        bump_kb_version(r["kb_id"])
+        return False
+    callback(1., "Done!")
+    DocumentService.increment_chunk_num(
+        r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
+    cron_logger.info(
+        "Chunk doc({}), token({}), chunks({}), elapsed:{}".format(
+            r["id"], tk_count, len(cks), timer()-st))
+    return True
+
+
+def do_handle_task(r):
+    """Chunk, embed and index one task. Returns False if the task is given up."""
+    #callback(random.random()/10., "Task has been received.")
+    embd_mdl = get_embd_mdl(r)
+    if embd_mdl is None:
+        return False
+
+    st = timer()
+    cks = build(r)
+    cron_logger.info("Build chunks({}): {}".format(r["name"], timer()-st))
+    if cks is None:
+        return False
+    if not cks:
+        set_progress(r["id"], r["from_page"], r["to_page"], 1., "No chunk! Done!")
+        return True
+    tk_count = do_embedding(r, cks, embd_mdl)
+    return do_index(r, cks, tk_count)
+
+
+def _limit_ocr_workers(n):
+    DEEPDOC["ocr_workers"] = n
+
+
+class TaskPipeline:
+    """
+    Overlaps the stages of consecutive tasks: while one task is embedding, the
+    next one is fetched and chunked in the process pool and the previous one
+    is bulk-indexed. Each stage has its own concurrency, and `submit` blocks
+    once `max_in_flight` tasks are in the pipeline.
+    """
+
+    def __init__(self, chunk_workers=1, embedding_workers=1, index_workers=1, max_in_flight=None):
+        # spawn: the workers load their own models and DB connections rather
+        # than inheriting forked ONNX sessions and pooled sockets.
+        # Every chunk worker may start an OCR pool, so the cores are shared among them.
+        ocr_workers = int(DEEPDOC.get("ocr_workers", 0)) or os.cpu_count() or 1
+        self.chunk_pool = ProcessPoolExecutor(max_workers=chunk_workers,
+                                              mp_context=multiprocessing.get_context("spawn"),
+                                              initializer=_limit_ocr_workers,
+                                              initargs=(max(1, ocr_workers // chunk_workers),))
+        self.embd_pool = ThreadPoolExecutor(max_workers=embedding_workers)
+        self.index_pool = ThreadPoolExecutor(max_workers=index_workers)
+        if not max_in_flight:
+            max_in_flight = chunk_workers + embedding_workers + index_workers
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+
+    def submit(self, r, done=None):
+        """Put a task into the pipeline. `done(r, ok)` is called once it leaves."""
+        self.slots.acquire()
+        try:
+            embd_mdl = get_embd_mdl(r)
+            if embd_mdl is None:
+                self._finish(r, False, done)
+                return
+            st = timer()
+            fut = self.chunk_pool.submit(build, r)
+        except BaseException as e:
+            self.slots.release()
+            raise e
+        fut.add_done_callback(
+            lambda f: self._step(r, done, partial(self._chunked, r, f, embd_mdl, st, done)))
+
+    def _finish(self, r, ok, done):
+        self.slots.release()
+        if done:
+            try:
+                done(r, ok)
+            except Exception as e:
+                cron_logger.exception(e)
+
+    def _step(self, r, done, callback):
+        """
+        Runs a stage's done-callback. Unless it returns None, having handed the
+        task over to the next stage, the task leaves the pipeline whatever happens.
+        """
+        ok = False
+        try:
+            ok = callback()
+        except SystemExit:
+            # set_progress exits once the task is canceled
+            ok = False
+        except Exception as e:
+            cron_logger.exception(e)
+        finally:
+            if ok is not None:
+                self._finish(r, ok, done)
+
+    def _failed(self, r, f, stage):
+        e = f.exception()
+        if e is None:
+            return False
+        if not isinstance(e, SystemExit):
+            cron_logger.error("{} {}: {}".format(stage, r["name"], str(e)))
+            set_progress(r["id"], r["from_page"], r["to_page"], prog=-1,
+                         msg="Internal server error: %s" % str(e).replace("'", ""))
+        return True
+
+    def _chunked(self, r, f, embd_mdl, st, done):
+        if self._failed(r, f, "Chunking"):
+            return False
+        cks = f.result()
+        cron_logger.info("Build chunks({}): {}".format(r["name"], timer() - st))
+        if cks is None:
+            return False
+        if not cks:
+            set_progress(r["id"], r["from_page"], r["to_page"], 1., "No chunk! Done!")
+            return True
+        fut = self.embd_pool.submit(do_embedding, r, cks, embd_mdl)
+        fut.add_done_callback(lambda f: self._step(r, done, partial(self._embedded, r, f, cks, done)))
+
+    def _embedded(self, r, f, cks, done):
+        if self._failed(r, f, "Embedding"):
+            return False
+        fut = self.index_pool.submit(do_index, r, cks, f.result())
+        fut.add_done_callback(lambda f: self._step(r, done, partial(self._indexed, r, f)))
+
+    def _indexed(self, r, f):
+        if self._failed(r, f, "Indexing"):
+            return False
+        return bool(f.result())
+
+    def shutdown(self, wait=True):
+        self.chunk_pool.shutdown(wait=wait)
+        self.embd_pool.shutdown(wait=wait)
+        self.index_pool.shutdown(wait=wait)
+
+
 def main(comm, mod):
     tm_fnm = os.path.join(
         get_project_base_directory(),
@@ -250,63 +453,76 @@ def main(comm, mod):
 
     tmf = open(tm_fnm, "a+")
     for _, r in rows.iterrows():
-        callback = partial(set_progress, r["id"], r["from_page"], r["to_page"])
-        #callback(random.random()/10., "Task has been received.")
-        try:
-            embd_mdl = LLMBundle(r["tenant_id"], LLMType.EMBEDDING, llm_name=r["embd_id"], lang=r["language"])
-        except Exception as e:
-            traceback.print_stack(e)
-            callback(prog=-1, msg=str(e))
+        if not do_handle_task(r):
             continue
+        tmf.write(str(r["update_time"]) + "\n")
+    tmf.close()
 
-        st = timer()
-        cks = build(r)
-        cron_logger.info("Build chunks({}): {}".format(r["name"], timer()-st))
-        if cks is None:
-            continue
-        if not cks:
+
+def consume(comm, mod):
+    """Queue mode: block on the task queue instead of polling MySQL under `DB.lock`."""
+    consumer = "task_executor_{}_{}".format(mod, os.getpid())
+    queue = get_task_queue()
+    msg = queue.consume(consumer, block=1000)
+    if not msg:
+        return
+    payload = msg.get_payload()
+    try:
+        rows = TaskService.get_task(payload["id"])
+        if not rows:
+            cron_logger.info("Task {} is finished or canceled, skip it.".format(payload["id"]))
+            return
+        if msg.deliveries > 1:
+            cron_logger.warning("Task {} is delivered {} times.".format(payload["id"], msg.deliveries))
+        cron_logger.info("TOTAL:1, From queue:{}".format(payload["id"]))
+        msg.keep_alive(consumer)
+        do_handle_task(rows[0])
+    finally:
+        msg.ack()
+
+
+def pipeline_main(comm, mod, pipeline):
+    tm_fnm = os.path.join(
+        get_project_base_directory(),
+        "rag/res",
+        f"{comm}-{mod}.tm")
+    tm = findMaxTm(tm_fnm)
+    rows = collect(comm, mod, tm)
+    if len(rows) == 0:
+        return
+
+    def done(r, ok):
+        if not ok:
+            return
+        with open(tm_fnm, "a+") as tmf:
             tmf.write(str(r["update_time"]) + "\n")
-            callback(1., "No chunk! Done!")
-            continue
-        # TODO: exception handler
-        ## set_progress(r["did"], -1, "ERROR: ")
-        callback(
-            msg="Finished slicing files(%d). Start to embedding the content." %
-            len(cks))
-        st = timer()
-        try:
-            tk_count = embedding(cks, embd_mdl, r["parser_config"], callback)
-        except Exception as e:
-            callback(-1, "Embedding error:{}".format(str(e)))
-            cron_logger.error(str(e))
-            tk_count = 0
-        cron_logger.info("Embedding elapsed({}): {}".format(r["name"], timer()-st))
-
-        callback(msg="Finished embedding({})! Start to build index!".format(timer()-st))
-        init_kb(r)
-        chunk_count = len(set([c["_id"] for c in cks]))
-        st = timer()
-        es_r = ELASTICSEARCH.bulk(cks, search.index_name(r["tenant_id"]))
-        cron_logger.info("Indexing elapsed({}): {}".format(r["name"], timer()-st))
-        if es_r:
-            callback(-1, "Index failure!")
-            ELASTICSEARCH.deleteByQuery(
-                Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-            cron_logger.error(str(es_r))
-        else:
-            if TaskService.do_cancel(r["id"]):
-                ELASTICSEARCH.deleteByQuery(
-                    Q("match", doc_id=r["doc_id"]), idxnm=search.index_name(r["tenant_id"]))
-                continue
-            callback(1., "Done!")
-            DocumentService.increment_chunk_num(
-                r["doc_id"], r["kb_id"], tk_count, chunk_count, 0)
-            cron_logger.info(
-                "Chunk doc({}), token({}), chunks({}), elapsed:{}".format(
-                    r["id"], tk_count, len(cks), timer()-st))
 
-        tmf.write(str(r["update_time"]) + "\n")
-    tmf.close()
+    for _, r in rows.iterrows():
+        pipeline.submit(r.to_dict(), done)
+
+
+def pipeline_consume(comm, mod, pipeline):
+    consumer = "task_executor_{}_{}".format(mod, os.getpid())
+    msg = get_task_queue().consume(consumer, block=1000)
+    if not msg:
+        return
+    payload = msg.get_payload()
+    try:
+        rows = TaskService.get_task(payload["id"])
+    except Exception as e:
+        msg.ack()
+        raise e
+    if not rows:
+        cron_logger.info("Task {} is finished or canceled, skip it.".format(payload["id"]))
+        msg.ack()
+        return
+    cron_logger.info("TOTAL:1, From queue:{}".format(payload["id"]))
+    msg.keep_alive(consumer)
+    try:
+        pipeline.submit(rows[0], lambda r, ok: msg.ack())
+    except BaseException as e:
+        msg.ack()
+        raise e
 
 
 if __name__ == "__main__":
@@ -315,8 +531,24 @@ if __name__ == "__main__":
     peewee_logger.addHandler(database_logger.handlers[0])
     peewee_logger.setLevel(database_logger.level)
 
+    MODEL_REGISTRY.warmup(WARMUP.get("executor", ["elasticsearch", "huqie"]))
+    startup_report("Task executor")
+
     #from mpi4py import MPI
     #comm = MPI.COMM_WORLD
+    pipeline = None
+    if TASK_EXECUTOR.get("pipeline"):
+        pipeline = TaskPipeline(chunk_workers=int(TASK_EXECUTOR.get("chunk_workers", 1)),
+                                embedding_workers=int(TASK_EXECUTOR.get("embedding_workers", 1)),
+                                index_workers=int(TASK_EXECUTOR.get("index_workers", 1)),
+                                max_in_flight=int(TASK_EXECUTOR.get("max_in_flight", 0)))
     while True:
-        main(int(sys.argv[2]), int(sys.argv[1]))
+        if pipeline and queue_enabled():
+            pipeline_consume(int(sys.argv[2]), int(sys.argv[1]), pipeline)
+        elif pipeline:
+            pipeline_main(int(sys.argv[2]), int(sys.argv[1]), pipeline)
+        elif queue_enabled():
+            consume(int(sys.argv[2]), int(sys.argv[1]))
+        else:
+            main(int(sys.argv[2]), int(sys.argv[1]))
         close_connection()
@@ -1,5 +1,9 @@
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
+
 import tiktoken
 
 
@@ -15,6 +19,47 @@ def singleton(cls, *args, **kw):
     return _singleton
 
 
+class LRUCache(object):
+    """Thread-safe LRU cache whose entries expire `ttl` seconds after they were put (never if ttl <= 0)."""
+
+    def __init__(self, capacity=10000, ttl=0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, k):
+        with self._lock:
+            if k not in self._data:
+                return
+            v, exp = self._data[k]
+            if exp and exp < time.time():
+                del self._data[k]
+                return
+            self._data.move_to_end(k)
+            return v
+
+    def put(self, k, v):
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._data[k] = (v, time.time() + self.ttl if self.ttl > 0 else 0)
+            self._data.move_to_end(k)
+            while len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+    def pop(self, k):
+        with self._lock:
+            return self._data.pop(k, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
 def rmSpace(txt):
     txt = re.sub(r"([^a-z0-9.,]) +([^ ])", r"\1\2", txt, flags=re.IGNORECASE)
     return re.sub(r"([^ ]) +([^a-z0-9.,])", r"\1\2", txt, flags=re.IGNORECASE)
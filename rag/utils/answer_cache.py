@@ -0,0 +1,138 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import copy
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+
+from rag.settings import ANSWER_CACHE as CONF
+from rag.utils import LRUCache
+from rag.utils.retrieval_cache import kb_versions
+
+
+class _Answers(object):
+    """Answers of one scope, looked up by the cosine similarity of their question vectors."""
+
+    def __init__(self):
+        self.vecs = []
+        self.answers = []
+        self.used = []
+        self.expires = []
+        self._mtx = None
+
+    def matrix(self):
+        if self._mtx is None:
+            self._mtx = np.vstack(self.vecs)
+        return self._mtx
+
+    def drop(self, i):
+        for l in [self.vecs, self.answers, self.used, self.expires]:
+            del l[i]
+        self._mtx = None
+
+
+class AnswerCache(object):
+    """
+    Answers of dialogs by question vector. The entries are scoped by the dialog,
+    a hash of its configuration and of the prompt parameters, and the versions
+    of its knowledgebases, so editing the dialog or re-indexing a knowledgebase
+    makes the previous answers unreachable.
+    A question gets the answer of the most similar cached one if their cosine
+    similarity reaches `threshold`. Every scope keeps at most `size` answers,
+    evicting the least recently used, and the scopes are evicted the same way.
+    """
+
+    def __init__(self, enabled=False, dialogs=1024, size=256, ttl=3600, threshold=0.95):
+        self.enabled = enabled
+        self.size = size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.scopes = LRUCache(dialogs)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def scope(self, dialog, kwargs):
+        """The scope of the dialog's answers, None if they are not to be cached."""
+        if not dialog.prompt_config.get("answer_cache", self.enabled) or self.size <= 0:
+            return
+        vs = kb_versions(dialog.kb_ids) if dialog.kb_ids else []
+        if vs is None:
+            return
+        conf = [dialog.llm_id, dialog.llm_setting, dialog.prompt_config, dialog.kb_ids,
+                dialog.similarity_threshold, dialog.vector_similarity_weight, dialog.top_n,
+                sorted(kwargs.items()), vs]
+        return dialog.id + ":" + hashlib.sha1(
+            json.dumps(conf, ensure_ascii=False, default=str).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def normalize(vec):
+        v = np.asarray(vec, dtype=np.float32)
+        n = np.linalg.norm(v)
+        return v / n if n else v
+
+    def get(self, scope, vec):
+        with self._lock:
+            ans = self.scopes.get(scope)
+            if ans is None or not ans.vecs:
+                self.misses += 1
+                return
+            vec = self.normalize(vec)
+            if ans.matrix().shape[1] != len(vec):
+                self.misses += 1
+                return
+            sims = ans.matrix() @ vec
+            i = int(np.argmax(sims))
+            if sims[i] < self.threshold:
+                self.misses += 1
+                return
+            if ans.expires[i] and ans.expires[i] < time.time():
+                ans.drop(i)
+                self.misses += 1
+                return
+            ans.used[i] = time.time()
+            self.hits += 1
+            return copy.deepcopy(ans.answers[i])
+
+    def put(self, scope, vec, answer):
+        with self._lock:
+            ans = self.scopes.get(scope)
+            if ans is None:
+                ans = _Answers()
+                self.scopes.put(scope, ans)
+            now = time.time()
+            while len(ans.vecs) >= self.size:
+                ans.drop(int(np.argmin(ans.used)))
+            ans.vecs.append(self.normalize(vec))
+            ans.answers.append(copy.deepcopy(answer))
+            ans.used.append(now)
+            ans.expires.append(now + self.ttl if self.ttl > 0 else 0)
+            ans._mtx = None
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"scopes": len(self.scopes), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.}
+
+
+ANSWER_CACHE = AnswerCache(enabled=bool(CONF.get("enabled", False)),
+                           dialogs=int(CONF.get("dialogs", 1024)),
+                           size=int(CONF.get("size", 256)),
+                           ttl=int(CONF.get("ttl", 3600)),
+                           threshold=float(CONF.get("threshold", 0.95)))
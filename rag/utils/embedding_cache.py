@@ -0,0 +1,89 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import hashlib
+import re
+
+import numpy as np
+
+from rag.settings import EMBEDDING_CACHE
+from rag.utils import LRUCache
+
+
+class QueryEmbeddingCache(object):
+    """
+    Caches the vectors of questions by (embedding factory, model name, normalized text).
+    It has an in-process LRU tier and, if `redis` is set, a shared Redis tier
+    behind it, both of which expire entries after `ttl` seconds.
+    """
+
+    PREFIX = "qemb:"
+
+    def __init__(self, size=10000, ttl=3600, redis=False):
+        self.ttl = ttl
+        self.redis = redis
+        self.mem = LRUCache(size, ttl)
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text):
+        return re.sub(r"\s+", " ", text).strip()
+
+    def key(self, factory, model_name, text):
+        return self.PREFIX + hashlib.sha1(
+            "\t".join([str(factory), str(model_name), self.normalize(text)]).encode("utf-8")).hexdigest()
+
+    def _redis(self):
+        if not self.redis:
+            return
+        from rag.utils.redis_conn import REDIS_CONN
+        if REDIS_CONN.is_alive():
+            return REDIS_CONN
+
+    def get(self, factory, model_name, text):
+        k = self.key(factory, model_name, text)
+        v = self.mem.get(k)
+        if v is not None:
+            self.hits += 1
+            return v
+        conn = self._redis()
+        if conn:
+            b = conn.get(k)
+            if b:
+                v = np.frombuffer(b, dtype=np.float64)
+                self.mem.put(k, v)
+                self.redis_hits += 1
+                return v
+        self.misses += 1
+
+    def put(self, factory, model_name, text, vector):
+        k = self.key(factory, model_name, text)
+        self.mem.put(k, vector)
+        conn = self._redis()
+        if conn:
+            conn.set(k, np.asarray(vector, dtype=np.float64).tobytes(), self.ttl if self.ttl > 0 else None)
+
+    def stats(self):
+        total = self.hits + self.redis_hits + self.misses
+        return {"size": len(self.mem), "hits": self.hits, "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.redis_hits) / total if total else 0.}
+
+
+QUERY_EMBEDDING_CACHE = QueryEmbeddingCache(size=int(EMBEDDING_CACHE.get("query_size", 10000)),
+                                            ttl=int(EMBEDDING_CACHE.get("query_ttl", 3600)),
+                                            redis=bool(EMBEDDING_CACHE.get("query_redis", False)))
@@ -0,0 +1,150 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from api.utils.file_utils import get_home_cache_dir
+from rag.settings import EMBEDDING_CACHE
+
+
+class EmbeddingStore(object):
+    """
+    Persistent vectors of embedded texts, keyed by (embedding model, md5 of the text),
+    so re-parsing a document or adding the same content to another knowledgebase
+    doesn't pay for the unchanged chunks again.
+    They live in a SQLite file shared by the processes of a host. Once it holds more
+    than `max_rows` vectors, the least recently used ones are evicted.
+    Any failure of the store is logged and taken as a miss.
+    """
+
+    def __init__(self, path, max_rows=500000, enabled=True):
+        self.path = path
+        self.max_rows = max_rows
+        self.enabled = enabled
+        self._local = threading.local()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _conn(self):
+        # sqlite connections are neither shared by threads nor inherited by forked processes
+        if getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS embd (mdl TEXT, md5 TEXT, vec BLOB, used REAL, "
+                         "PRIMARY KEY (mdl, md5)) WITHOUT ROWID")
+            conn.execute("CREATE INDEX IF NOT EXISTS embd_used ON embd (used)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return self._local.conn
+
+    @staticmethod
+    def model_key(mdl):
+        """`mdl` is an LLMBundle or an embedding model; None if its model can't be told apart."""
+        m = getattr(mdl, "mdl", mdl)
+        nm = getattr(m, "model_name", None) or getattr(mdl, "llm_name", None)
+        if not nm:
+            return
+        # the model behind an embedding server is the one it was started with
+        addr = getattr(getattr(m, "model", None), "address", None)
+        if addr:
+            nm = "{}@{}:{}".format(nm, *addr)
+        return "{}/{}".format(m.__class__.__name__, nm)
+
+    @staticmethod
+    def md5(text):
+        return hashlib.md5(text.encode("utf-8", "surrogatepass")).hexdigest()
+
+    def get(self, mdl_key, texts):
+        """Stored vectors of `texts`, None for the missing ones."""
+        md5s = [self.md5(t) for t in texts]
+        found = {}
+        try:
+            conn = self._conn()
+            for i in range(0, len(md5s), 500):
+                ks = md5s[i: i + 500]
+                for k, v in conn.execute("SELECT md5, vec FROM embd WHERE mdl=? AND md5 IN ({})".format(
+                        ",".join(["?"] * len(ks))), [mdl_key] + ks):
+                    found[k] = np.frombuffer(v, dtype=np.float32)
+            if found:
+                with conn:
+                    conn.executemany("UPDATE embd SET used=? WHERE mdl=? AND md5=?",
+                                     [(time.time(), mdl_key, k) for k in found])
+        except Exception as e:
+            logging.warning("Embedding store get: {}".format(e))
+        self.hits += len(found)
+        self.misses += len(set(md5s)) - len(found)
+        return [found.get(k) for k in md5s]
+
+    def put(self, mdl_key, texts, vecs):
+        now = time.time()
+        try:
+            conn = self._conn()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO embd (mdl, md5, vec, used) VALUES (?, ?, ?, ?)",
+                                 [(mdl_key, self.md5(t), np.asarray(v, dtype=np.float32).tobytes(), now)
+                                  for t, v in zip(texts, vecs)])
+            self._puts += len(texts)
+            if self._puts >= max(1000, self.max_rows // 100):
+                self._puts = 0
+                self.evict()
+        except Exception as e:
+            logging.warning("Embedding store put: {}".format(e))
+
+    def evict(self):
+        conn = self._conn()
+        n = conn.execute("SELECT COUNT(*) FROM embd").fetchone()[0]
+        if n <= self.max_rows:
+            return
+        with conn:
+            conn.execute("DELETE FROM embd WHERE (mdl, md5) IN "
+                         "(SELECT mdl, md5 FROM embd ORDER BY used LIMIT ?)", (n - self.max_rows,))
+
+    def encode(self, mdl, texts):
+        """
+        mdl.encode(texts), reusing the stored vectors; the token count is
+        the one of the texts actually encoded.
+        """
+        mdl_key = self.model_key(mdl) if self.enabled else None
+        if not mdl_key:
+            return mdl.encode(texts)
+        vecs = self.get(mdl_key, texts)
+        miss = [i for i, v in enumerate(vecs) if v is None]
+        tk_count = 0
+        if miss:
+            vts, tk_count = mdl.encode([texts[i] for i in miss])
+            self.put(mdl_key, [texts[i] for i in miss], vts)
+            for i, v in zip(miss, vts):
+                vecs[i] = v
+        return np.array(vecs), tk_count
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.}
+
+
+EMBEDDING_STORE = EmbeddingStore(
+    path=EMBEDDING_CACHE.get("store_path") or os.path.join(get_home_cache_dir(), "embedding_store.db"),
+    max_rows=int(EMBEDDING_CACHE.get("store_rows", 500000)),
+    enabled=bool(EMBEDDING_CACHE.get("store", False)))
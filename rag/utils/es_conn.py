@@ -10,6 +10,7 @@ from elasticsearch_dsl import UpdateByQuery, Search, Index
 from rag.settings import es_logger
 from rag import settings
 from rag.utils import singleton
+from rag.utils.model_registry import LazyModel
 
 es_logger.info("Elasticsearch version: "+str(elasticsearch.__version__))
 
@@ -242,6 +243,35 @@ class ESConnection:
         es_logger.error("ES search timeout for 3 times!")
         raise Exception("ES search timeout.")
 
+    def msearch(self, qs, idxnm=None, timeout="2s"):
+        """Run the (query, _source) pairs of `qs` in one _msearch request, the responses in the same order."""
+        searches = []
+        for q, src in qs:
+            if not isinstance(q, dict):
+                q = Search().query(q).to_dict()
+            searches.append({"index": self.idxnm if not idxnm else idxnm})
+            searches.append(dict(q, _source=src, timeout=timeout, track_total_hits=True))
+        for i in range(3):
+            try:
+                res = self.es.msearch(searches=searches)["responses"]
+                for r in res:
+                    if "error" in r:
+                        raise Exception(str(r["error"]))
+                    if str(r.get("timed_out", "")).lower() == "true":
+                        raise Exception("Es Timeout.")
+                return res
+            except Exception as e:
+                es_logger.error(
+                    "ES msearch exception: " +
+                    str(e) +
+                    "【Q】：" +
+                    str(searches))
+                if str(e).find("Timeout") > 0:
+                    continue
+                raise e
+        es_logger.error("ES msearch timeout for 3 times!")
+        raise Exception("ES msearch timeout.")
+
     def sql(self, sql, fetch_size=128, format="json", timeout="2s"):
         for i in range(3):
             try:
@@ -454,4 +484,5 @@ class ESConnection:
             scroll_size = len(page['hits']['hits'])
 
 
-ELASTICSEARCH = ESConnection()
+# connects, and pings, on first use
+ELASTICSEARCH = LazyModel("elasticsearch", ESConnection)
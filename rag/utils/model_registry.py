@@ -0,0 +1,160 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import os
+import threading
+import time
+from timeit import default_timer as timer
+
+from rag.settings import cron_logger
+
+
+class ModelRegistry(object):
+    """
+    Process-wide registry of warm models and other heavy resources keyed by
+    species, e.g. "ocr", "layout", "layout.paper", "tsr", "updown_concat_xgb",
+    "huqie", "bge-large-zh-v1.5" or "elasticsearch".
+
+    Lifecycle:
+        - A model is built by its factory the first time it's asked for (or
+          by `warmup`) and then lives until `release`/`clear` is called.
+          Factories may be registered ahead, see `register` and `LazyModel`,
+          so that a process warms up its models by species only.
+        - Entries are per process: a forked child builds its own copies
+          instead of reusing ONNX sessions inherited from its parent.
+
+    Thread-safety:
+        - Every species is built at most once, even when several threads
+          ask for it at the same time; other species are not blocked meanwhile.
+        - The registered models are shared, so they must be safe to call
+          concurrently. ONNX Runtime sessions and xgboost's Booster.predict are.
+          Parsers which keep per-document state (boxes, page images...) must
+          not be registered; they should borrow the models instead.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._locks = {}
+        self._factories = {}
+        self._seconds = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(species):
+        return "{}@{}".format(species, os.getpid())
+
+    def _species_lock(self, key):
+        with self._lock:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def register(self, species, factory):
+        """Remember how to build a species without building it."""
+        self._factories[species] = factory
+
+    def get(self, species, factory=None):
+        key = self._key(species)
+        mdl = self._models.get(key)
+        if mdl is not None:
+            return mdl
+        with self._species_lock(key):
+            mdl = self._models.get(key)
+            if mdl is not None:
+                return mdl
+            if factory is None:
+                factory = self._factories[species]
+            st = timer()
+            mdl = factory()
+            self._models[key] = mdl
+            self._seconds[key] = timer() - st
+            cron_logger.info("Load model({}): {}".format(species, self._seconds[key]))
+            return mdl
+
+    def warmup(self, factories):
+        """
+        `factories` maps model species to the callable building it, or lists
+        registered species; the unknown ones are skipped.
+        """
+        if not isinstance(factories, dict):
+            factories = {s: self._factories[s] for s in factories if s in self._factories}
+        for species, factory in factories.items():
+            self.get(species, factory)
+
+    def loaded(self, species):
+        return self._key(species) in self._models
+
+    def release(self, species):
+        key = self._key(species)
+        with self._species_lock(key):
+            self._seconds.pop(key, None)
+            return self._models.pop(key, None) is not None
+
+    def clear(self):
+        for key in list(self._models.keys()):
+            with self._species_lock(key):
+                self._seconds.pop(key, None)
+                self._models.pop(key, None)
+
+    def report(self):
+        """Loading seconds of the species built by this process, None for the registered ones not built yet."""
+        res = {s: None for s in self._factories}
+        suffix = "@{}".format(os.getpid())
+        for key, sec in list(self._seconds.items()):
+            if key.endswith(suffix):
+                res[key[:-len(suffix)]] = sec
+        return res
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+class LazyModel(object):
+    """
+    Module-level handle of a model registered in MODEL_REGISTRY. The model is
+    built on first use; attribute accesses and calls go to it.
+    """
+
+    def __init__(self, species, factory, registry=MODEL_REGISTRY):
+        self._species = species
+        self._registry = registry
+        registry.register(species, factory)
+
+    def get(self):
+        return self._registry.get(self._species)
+
+    def __getattr__(self, k):
+        if k.startswith("_"):
+            raise AttributeError(k)
+        return getattr(self.get(), k)
+
+    def __call__(self, *args, **kwargs):
+        return self.get()(*args, **kwargs)
+
+
+def startup_report(name):
+    """Logs how long the process took to get ready and which models it loaded meanwhile."""
+    try:
+        import psutil
+        elapsed = time.time() - psutil.Process(os.getpid()).create_time()
+    except Exception as e:
+        elapsed = None
+    rpt = MODEL_REGISTRY.report()
+    loaded = ["{}({:.2f}s)".format(s, sec) for s, sec in rpt.items() if sec is not None]
+    deferred = [s for s, sec in rpt.items() if sec is None]
+    cron_logger.info("{} ready{}. Loaded: {}. Deferred: {}.".format(
+        name, " in {:.2f}s".format(elapsed) if elapsed is not None else "",
+        ", ".join(loaded) or "-", ", ".join(deferred) or "-"))
+    return {"name": name, "seconds": elapsed, "models": rpt}
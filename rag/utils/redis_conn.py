@@ -59,6 +59,21 @@ class RedisDB:
             self.__open__()
         return False
 
+    def incr(self, k):
+        try:
+            return self.REDIS.incr(k)
+        except Exception as e:
+            logging.warning("[EXCEPTION]incr" + str(k) + "||" + str(e))
+            self.__open__()
+
+    def mget(self, ks):
+        if not self.REDIS: return
+        try:
+            return self.REDIS.mget(ks)
+        except Exception as e:
+            logging.warning("[EXCEPTION]mget" + str(ks) + "||" + str(e))
+            self.__open__()
+
     def transaction(self, key, value, exp=3600):
         try:
             pipeline = self.REDIS.pipeline(transaction=True)
@@ -0,0 +1,82 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import hashlib
+import json
+
+from rag.settings import RETRIEVAL_CACHE as CONF
+from rag.utils import LRUCache
+from rag.utils.redis_conn import REDIS_CONN
+
+KB_VERSION_PREFIX = "kb_version:"
+
+
+def kb_versions(kb_ids):
+    """Current versions of the knowledgebases, None if they can't be read."""
+    if not REDIS_CONN.is_alive():
+        return
+    vs = REDIS_CONN.mget([KB_VERSION_PREFIX + str(kb_id) for kb_id in kb_ids])
+    if vs is None:
+        return
+    return [int(v) if v else 0 for v in vs]
+
+
+def bump_kb_version(*kb_ids):
+    """To be called whenever chunks of the knowledgebases are indexed, edited or deleted."""
+    if not REDIS_CONN.is_alive():
+        return
+    for kb_id in set(kb_ids):
+        REDIS_CONN.incr(KB_VERSION_PREFIX + str(kb_id))
+
+
+class RetrievalCache(object):
+    """
+    Ranked retrieval results by the request and the versions of the knowledgebases
+    it searches. Bumping a version makes the previous entries unreachable; they are
+    then evicted as the least recently used or by the ttl.
+    """
+
+    def __init__(self, size=64, ttl=600):
+        self.mem = LRUCache(size, ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kb_ids, *args):
+        if self.mem.capacity <= 0 or not kb_ids:
+            return
+        vs = kb_versions(kb_ids)
+        if vs is None:
+            return
+        return hashlib.sha1(json.dumps([list(kb_ids), vs, args], ensure_ascii=False, default=str)
+                            .encode("utf-8")).hexdigest()
+
+    def get(self, k):
+        v = self.mem.get(k)
+        if v is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return v
+
+    def put(self, k, v):
+        self.mem.put(k, v)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self.mem), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.}
+
+
+RETRIEVAL_CACHE = RetrievalCache(size=int(CONF.get("size", 64)), ttl=int(CONF.get("ttl", 600)))
@@ -0,0 +1,272 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+"""
+Push-based task dispatching between task_broker and task_executor.
+
+The broker produces task payloads, executors block on consume(), and a
+message stays pending until it is acked. A pending message which is not
+acked (nor touched) within `visibility_timeout` seconds is delivered again
+to the next consumer, so a crashed executor doesn't lose its task.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from rag import settings
+
+TASK_QUEUE_NAME = "rag_flow_svr_queue"
+TASK_QUEUE_GROUP = "rag_flow_svr_task_executor"
+
+
+class QueueMessage:
+    def __init__(self, queue, msg_id, payload, deliveries=1):
+        self.queue = queue
+        self.msg_id = msg_id
+        self.payload = payload
+        self.deliveries = deliveries
+        self._alive = None
+
+    def ack(self):
+        if self._alive:
+            self._alive.set()
+        return self.queue.ack(self.msg_id)
+
+    def touch(self, consumer):
+        """Postpone the redelivery of a message which is still being processed."""
+        return self.queue.touch(self.msg_id, consumer)
+
+    def keep_alive(self, consumer, interval=None):
+        """
+        Touch the message every `interval` seconds, a third of the visibility
+        timeout by default, until it's acked; a single stage of a task may
+        last longer than the timeout.
+        """
+        if interval is None:
+            interval = max(1, self.queue.visibility_timeout / 3)
+        self._alive = threading.Event()
+
+        def beat(alive):
+            while not alive.wait(interval):
+                self.touch(consumer)
+
+        t = threading.Thread(target=beat, args=(self._alive,))
+        t.daemon = True
+        t.start()
+
+    def get_payload(self):
+        return self.payload
+
+
+class MemoryQueue:
+    """In-process stand-in of RedisQueue, for tests and single process deployment."""
+
+    def __init__(self, name=TASK_QUEUE_NAME, visibility_timeout=3600):
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self._cond = threading.Condition()
+        self._ready = OrderedDict()
+        # msg_id -> [payload, consumer, deadline, deliveries]
+        self._pending = {}
+        self._seq = 0
+
+    def produce(self, payload):
+        with self._cond:
+            self._seq += 1
+            msg_id = "%d-%d" % (int(time.time() * 1000), self._seq)
+            self._ready[msg_id] = [payload, 0]
+            self._cond.notify()
+            return msg_id
+
+    def _reclaim(self):
+        now = time.time()
+        for msg_id, (payload, _, deadline, deliveries) in list(self._pending.items()):
+            if deadline > now:
+                continue
+            del self._pending[msg_id]
+            self._ready[msg_id] = [payload, deliveries]
+            self._ready.move_to_end(msg_id, last=False)
+
+    def consume(self, consumer, block=1000):
+        deadline = time.time() + block / 1000.
+        with self._cond:
+            while True:
+                self._reclaim()
+                if self._ready:
+                    msg_id, (payload, deliveries) = self._ready.popitem(last=False)
+                    deliveries += 1
+                    self._pending[msg_id] = [payload, consumer,
+                                             time.time() + self.visibility_timeout, deliveries]
+                    return QueueMessage(self, msg_id, payload, deliveries)
+                left = deadline - time.time()
+                if left <= 0:
+                    return None
+                self._cond.wait(min(left, self.visibility_timeout))
+
+    def ack(self, msg_id):
+        with self._cond:
+            return self._pending.pop(msg_id, None) is not None
+
+    def touch(self, msg_id, consumer):
+        with self._cond:
+            if msg_id not in self._pending:
+                return False
+            self._pending[msg_id][1] = consumer
+            self._pending[msg_id][2] = time.time() + self.visibility_timeout
+            return True
+
+    def qsize(self):
+        with self._cond:
+            return len(self._ready)
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+
+class RedisQueue:
+    """Redis stream with a consumer group. Unacked entries are reclaimed with XAUTOCLAIM."""
+
+    def __init__(self, name=TASK_QUEUE_NAME, group=TASK_QUEUE_GROUP, visibility_timeout=3600):
+        from rag.utils.redis_conn import REDIS_CONN
+        self.conn = REDIS_CONN
+        self.name = name
+        self.group = group
+        self.visibility_timeout = visibility_timeout
+        self._group_ready = False
+
+    def _ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            self.conn.REDIS.xgroup_create(self.name, self.group, id="0", mkstream=True)
+        except Exception as e:
+            if "BUSYGROUP" not in str(e):
+                raise e
+        self._group_ready = True
+
+    def produce(self, payload):
+        for _ in range(3):
+            try:
+                self._ensure_group()
+                return self.conn.REDIS.xadd(self.name, {"message": json.dumps(payload, ensure_ascii=False)})
+            except Exception as e:
+                logging.warning("[EXCEPTION]produce" + str(self.name) + "||" + str(e))
+                self._group_ready = False
+                self.conn.__open__()
+                time.sleep(1)
+        raise Exception("Fail to put message into queue: {}".format(self.name))
+
+    def _message(self, msg_id, fields, deliveries):
+        msg_id = msg_id.decode("utf-8") if isinstance(msg_id, bytes) else msg_id
+        payload = fields.get(b"message", fields.get("message"))
+        return QueueMessage(self, msg_id, json.loads(payload), deliveries)
+
+    def _redeliver(self, consumer):
+        r = self.conn.REDIS.xautoclaim(self.name, self.group, consumer,
+                                       int(self.visibility_timeout * 1000),
+                                       start_id="0-0", count=1)
+        # [next_start_id, [(id, fields), ...], deleted_ids] since Redis 7
+        claimed = [m for m in r[1] if m and m[1]]
+        if not claimed:
+            return None
+        msg_id, fields = claimed[0]
+        deliveries = 2
+        try:
+            p = self.conn.REDIS.xpending_range(self.name, self.group, min=msg_id, max=msg_id, count=1)
+            if p:
+                deliveries = p[0]["times_delivered"]
+        except Exception as e:
+            pass
+        return self._message(msg_id, fields, deliveries)
+
+    def consume(self, consumer, block=1000):
+        try:
+            self._ensure_group()
+            msg = self._redeliver(consumer)
+            if msg:
+                return msg
+            r = self.conn.REDIS.xreadgroup(self.group, consumer, {self.name: ">"}, count=1, block=block)
+            if not r:
+                return None
+            for _, msgs in r:
+                for msg_id, fields in msgs:
+                    return self._message(msg_id, fields, 1)
+        except Exception as e:
+            logging.warning("[EXCEPTION]consume" + str(self.name) + "||" + str(e))
+            self._group_ready = False
+            self.conn.__open__()
+            time.sleep(block / 1000.)
+        return None
+
+    def ack(self, msg_id):
+        try:
+            self.conn.REDIS.xack(self.name, self.group, msg_id)
+            self.conn.REDIS.xdel(self.name, msg_id)
+            return True
+        except Exception as e:
+            logging.warning("[EXCEPTION]ack" + str(self.name) + "||" + str(e))
+            self.conn.__open__()
+        return False
+
+    def touch(self, msg_id, consumer):
+        try:
+            self.conn.REDIS.xclaim(self.name, self.group, consumer, 0, [msg_id], justid=True)
+            return True
+        except Exception as e:
+            logging.warning("[EXCEPTION]touch" + str(self.name) + "||" + str(e))
+            self.conn.__open__()
+        return False
+
+    def qsize(self):
+        try:
+            return self.conn.REDIS.xlen(self.name) - self.pending()
+        except Exception as e:
+            logging.warning("[EXCEPTION]qsize" + str(self.name) + "||" + str(e))
+        return 0
+
+    def pending(self):
+        try:
+            return self.conn.REDIS.xpending(self.name, self.group)["pending"]
+        except Exception as e:
+            logging.warning("[EXCEPTION]pending" + str(self.name) + "||" + str(e))
+        return 0
+
+
+QUEUE_BACKENDS = {
+    "redis": RedisQueue,
+    "memory": MemoryQueue,
+}
+
+_queues = {}
+_lock = threading.Lock()
+
+
+def queue_enabled():
+    return settings.TASK_QUEUE.get("backend", "db") in QUEUE_BACKENDS
+
+
+def get_task_queue(name=TASK_QUEUE_NAME):
+    backend = settings.TASK_QUEUE.get("backend", "db")
+    if backend not in QUEUE_BACKENDS:
+        raise ValueError("Task queue backend '{}' is not supported.".format(backend))
+    with _lock:
+        if name not in _queues:
+            _queues[name] = QUEUE_BACKENDS[backend](
+                name=name,
+                visibility_timeout=int(settings.TASK_QUEUE.get("visibility_timeout", 3600)))
+        return _queues[name]
@@ -0,0 +1,99 @@
+#
+#  Copyright 2024 The InfiniFlow Authors. All Rights Reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+import hashlib
+
+import numpy as np
+
+from rag.utils import LRUCache, encoder
+
+
+class TokenCounter(object):
+    """
+    Counts tokens with `rag.utils.encoder`, caching the counts by content hash,
+    so that the messages of a conversation or the chunks of a knowledge base
+    are encoded once however many times they are counted.
+    """
+
+    def __init__(self, size=50000, num_threads=4):
+        self.cache = LRUCache(size)
+        self.num_threads = num_threads
+
+    @staticmethod
+    def key(text):
+        return hashlib.md5(text.encode("utf-8", "surrogatepass")).digest()
+
+    def count(self, text):
+        k = self.key(text)
+        n = self.cache.get(k)
+        if n is None:
+            n = len(encoder.encode(text))
+            self.cache.put(k, n)
+        return n
+
+    def count_batch(self, texts):
+        """Token counts of `texts`; the uncached ones are encoded in one batch."""
+        keys = [self.key(t) for t in texts]
+        counts = [self.cache.get(k) for k in keys]
+        miss = [i for i, n in enumerate(counts) if n is None]
+        if len(miss) == 1:
+            counts[miss[0]] = self.count(texts[miss[0]])
+        elif miss:
+            for i, tks in zip(miss, encoder.encode_batch([texts[i] for i in miss],
+                                                          num_threads=self.num_threads)):
+                counts[i] = len(tks)
+                self.cache.put(keys[i], counts[i])
+        return counts
+
+    def truncate(self, text, max_tokens):
+        """
+        The first `max_tokens` tokens of `text`. Only a prefix of the text, a bit
+        longer than the average token length tells, is encoded.
+        """
+        if max_tokens <= 0:
+            return ""
+        n = self.count(text)
+        if n <= max_tokens:
+            return text
+        chars = int(len(text) * (max_tokens + 16) / n) + 64
+        while True:
+            tks = encoder.encode(text[:chars])
+            # the last word of the prefix may be tokenized differently from the whole text
+            if len(tks) > max_tokens + 16 or chars >= len(text):
+                break
+            chars *= 2
+        return encoder.decode(tks[:max_tokens])
+
+
+def plan_batches(counts, token_budget, max_batch=0):
+    """
+    Splits the indices of texts with token `counts` into batches of texts of
+    similar lengths, shortest first. A batch is padded to its longest text, so
+    it costs at most `token_budget` padded tokens, or holds a single text, and
+    has at most `max_batch` texts if it's set.
+    """
+    batches, cur = [], []
+    for i in np.argsort(counts, kind="stable"):
+        if cur and ((len(cur) + 1) * max(int(counts[i]), 1) > token_budget
+                    or (max_batch and len(cur) >= max_batch)):
+            batches.append(cur)
+            cur = []
+        cur.append(int(i))
+    if cur:
+        batches.append(cur)
+    return batches
+
+
+TOKEN_COUNTER = TokenCounter()